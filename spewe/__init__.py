@@ -17,17 +17,27 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import calendar
 import datetime
 import os
 import re
-import time
 import traceback
+from functools import partial
 from wsgiref import simple_server
 
-from spewe import exceptions
+from spewe import exceptions, serializers
+from spewe.cache import CachePolicy, LRUCache, ResponseCache
+from spewe.compress import compress_response
 from spewe.http import status
-from spewe.http import (Request, Response, ResponseNoContent, TemplateResponse)
-from spewe.utils import render_template
+from spewe.http import (ClosingIterator, JsonResponse, Request, Response, ResponseNoContent,
+                        ResponseNotModified, TemplateResponse, conditional_response, http_date, http_now,
+                        is_not_modified)
+from spewe.routing import Router
+from spewe.server import PreforkServer, make_server_class
+from spewe.static import StaticFiles
+from spewe.stats import Stats, Timing
+from spewe.template import TemplateLoader
+from spewe.utils import iscoroutinefunction, render_template
 
 
 class Settings(dict):
@@ -37,6 +47,22 @@ class Settings(dict):
         kwargs.setdefault('BASE_DIR', '')
         kwargs.setdefault('TEMPLATE_DIR', os.path.join(kwargs['BASE_DIR'], kwargs.get('TEMPLATE_DIR', 'templates')))
         kwargs.setdefault('STATIC_DIR', os.path.join(kwargs['BASE_DIR'], kwargs.get('STATIC_DIR', 'static')))
+        kwargs.setdefault('TEMPLATE_CACHE_SIZE', 128)
+        kwargs.setdefault('TEMPLATE_CHECK_INTERVAL', 2)
+        kwargs.setdefault('MAX_BODY_SIZE', None)
+        kwargs.setdefault('ETAGS', False)
+        kwargs.setdefault('COMPRESSION', False)
+        kwargs.setdefault('COMPRESSION_MIN_SIZE', 500)
+        kwargs.setdefault('COMPRESSION_LEVEL', 6)
+        kwargs.setdefault('STATIC_URL', '/static/')
+        kwargs.setdefault('STATIC_MAX_AGE', 3600)
+        kwargs.setdefault('ASGI_THREADS', None)
+        kwargs.setdefault('RESPONSE_CACHE_SIZE', 32 * 1024 * 1024)
+        kwargs.setdefault('FRAGMENT_CACHE_SIZE', 8 * 1024 * 1024)
+        kwargs.setdefault('JSON_BACKEND', None)
+        kwargs.setdefault('TIMING', False)
+        kwargs.setdefault('SERVER_TIMING', False)
+        kwargs.setdefault('STATS_URL', None)
         self.__dict__.update(kwargs)
         super(Settings, self).__init__(self, **self.__dict__)
 
@@ -44,80 +70,367 @@ class Settings(dict):
 class Spewe(object):
 
     def __init__(self, settings=None):
-        self.environ = None
-        self.start_response = None
-        self.routes = []
+        self.router = Router()
         if not settings:
             settings = {}
         BASE_DIR = os.path.dirname(traceback.extract_stack()[-2][0])
         settings.setdefault('BASE_DIR', BASE_DIR)
         self.settings = Settings(**settings)
+        if self.settings.JSON_BACKEND:
+            serializers.set_backend(self.settings.JSON_BACKEND)
+        self.fragment_cache = LRUCache(self.settings.FRAGMENT_CACHE_SIZE)
+        self.template_loader = TemplateLoader(
+            self.settings.TEMPLATE_DIR, max_size=self.settings.TEMPLATE_CACHE_SIZE,
+            check_interval=self.settings.TEMPLATE_CHECK_INTERVAL if self.settings.DEBUG else None,
+            cache=self.fragment_cache)
+        self.static = None
+        if self.settings.STATIC_URL:
+            self.static = StaticFiles(
+                self.settings.STATIC_DIR, url=self.settings.STATIC_URL,
+                max_age=self.settings.STATIC_MAX_AGE,
+                check_interval=self.settings.TEMPLATE_CHECK_INTERVAL if self.settings.DEBUG else None)
+        self.response_cache = ResponseCache(LRUCache(self.settings.RESPONSE_CACHE_SIZE))
+        # hooks, flattened in the routes by build_hooks
+        self._before, self._after, self._teardown = [], [], []
+        self.after_hooks = self.teardown_hooks = ()
+        self.stats = None
+        if self.settings.TIMING or self.settings.SERVER_TIMING or self.settings.STATS_URL:
+            self.stats = Stats()
+        self._asgi = None
 
-    def __call__(self, env, start_response):
-        self.environ = env
-        self.start_response = start_response
-        request = Request(env)
-        response = self.handle(Request(env))
-        http_status_code = status.describe(response.status_code)
-        response.add_header('Server', request.server_name)
-        response.add_header('Date', self.gmtdate)
-        self.start_response(http_status_code,
-                            response.headers.items())
-        return [response.data.encode('utf-8')]
+    @property
+    def routes(self):
+        return self.router.routes
+
+    def __call__(self, env, start_response, send=None):
+        if send is not None:
+            # called as an asgi application: (scope, receive, send)
+            return self.asgi(env, start_response, send)
+        timing = None
+        if self.stats is not None:
+            timing = env['spewe.timing'] = Timing()
+        request = Request(env, max_body_size=self.settings.MAX_BODY_SIZE)
+        if timing is not None:
+            timing.mark('request')
+        try:
+            response = self.finalize(request, self.handle(request))
+        except (Exception,) as exception:
+            if self.teardown_hooks:
+                self.run_teardown_hooks(request, exception)
+            raise
+        headers = response.headerlist
+        body = response.get_body(env)
+        if type(body) is list and response.status_code not in (204, 304) \
+                and not response.get_header('Content-Length'):
+            headers.append(('Content-Length', str(sum(len(chunk) for chunk in body))))
+        if timing is not None:
+            self.record_timing(timing, response)
+        start_response(status.describe(response.status_code), headers)
+        if self.teardown_hooks:
+            if type(body) is list:
+                self.run_teardown_hooks(request, None)
+            else:
+                # a streamed body is still being produced: tear down
+                # once the server closes it
+                close = partial(self.close_body, request, getattr(body, 'close', None))
+                file_wrapper = env.get('wsgi.file_wrapper')
+                if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+                    # handed as is, the server may send the file itself
+                    body.close = close
+                else:
+                    body = ClosingIterator(body, close=close)
+        return body
+
+    def close_body(self, request, close):
+        try:
+            if close is not None:
+                close()
+        finally:
+            self.run_teardown_hooks(request, None)
+
+    def record_timing(self, timing, response):
+        """End the request timing, adding it to the stats and, with
+        SERVER_TIMING, to the response headers
+        """
+        timing.mark('encode')
+        self.stats.record(timing)
+        if self.settings.SERVER_TIMING:
+            response.headerlist.append(('Server-Timing', timing.server_timing()))
+
+    @property
+    def asgi(self):
+        """The ASGI 3 application, for servers which can't detect that
+        the app itself also speaks ASGI
+        """
+        if self._asgi is None:
+            from spewe.asgi import ASGIHandler
+            self._asgi = ASGIHandler(self)
+        return self._asgi
+
+    def finalize(self, request, response):
+        """Apply the conditional GET, compression and common headers"""
+        response = conditional_response(request, response, add_etag=self.settings.ETAGS)
+        if self.settings.COMPRESSION:
+            response = compress_response(request, response, min_size=self.settings.COMPRESSION_MIN_SIZE,
+                                         level=self.settings.COMPRESSION_LEVEL)
+        response.headerlist.append(('Server', request.server_name))
+        response.headerlist.append(('Date', http_now()))
+        return response
 
     @property
     def gmtdate(self):
-        gmt = time.mktime(time.gmtime())
-        gmt = datetime.datetime.fromtimestamp(gmt)
-        return gmt.strftime('%a, %d %b %Y %H:%M:%S GMT')
+        return http_now()
 
     def run(self, server_name='localhost', port=8099,
-            server_class=simple_server.WSGIServer, handler_class=simple_server.WSGIRequestHandler):
-        """Create a wsgi server
+            server_class=simple_server.WSGIServer, handler_class=simple_server.WSGIRequestHandler,
+            threads=None, backlog=None, workers=None, max_requests=None, reuse_port=False,
+            server=None, **options):
+        """Create a wsgi server.
+
+        With `threads`, requests are handled by a pool of that many worker
+        threads. `backlog` sets the size of the listen queue.
+        With `workers`, that many processes are forked to share the socket,
+        each one being replaced after `max_requests` requests if set.
+        `reuse_port` sets SO_REUSEPORT on the listening socket.
+        With `server='asyncio'`, the app is served by the HTTP/1.1 asyncio
+        server instead, `options` being passed to AsyncioServer.
         """
+        if server == 'asyncio':
+            from spewe.aioserver import AsyncioServer
+            httpd = AsyncioServer(self, server_name, port, backlog=backlog, **options)
+            print('Started http://localhost:%d/' % port)
+            httpd.serve_forever()
+            return
+        server_class = make_server_class(server_class, threads=threads, backlog=backlog)
+        if workers:
+            server = PreforkServer(self, server_name, port, server_class, handler_class,
+                                   workers=workers, max_requests=max_requests, reuse_port=reuse_port)
+            server.bind()
+            print('Started http://localhost:%d/ with %d workers' % (port, workers))
+            server.serve_forever()
+            return
         httpd = simple_server.make_server(server_name, port, self,
                                           server_class=server_class, handler_class=handler_class)
         print('Started http://localhost:%d/' % port)
         httpd.serve_forever()
 
-    def handle(self, request, *args, **kwargs):
-        for route in self.routes:
-            if route.url_match(request):
-                break
+    def invalidate_cache(self, name=None):
+        """Drop the cached responses of the route `name`, or all of them"""
+        if name is None:
+            self.response_cache.clear()
         else:
-            return Response(data='Page not found', status_code=status.HTTP_404_NOT_FOUND)
+            self.response_cache.invalidate(name)
 
-        if not route.is_method_allowed(request.method):
-            return Response(data='Method not allowed', status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+    def warmup(self):
+        """Build the router and load the routes templates"""
+        self.router.build()
+        for route in self.routes:
+            if route.template:
+                try:
+                    self.template_loader.get_template(route.template)
+                except (exceptions.TemplateNotFound,):
+                    pass
+
+    def handle(self, request, *args, **kwargs):
+        response, route = self.resolve(request, args, kwargs)
+        if self.stats is not None:
+            self.mark_timing(request, 'routing')
+        if route is None:
+            if self.after_hooks:
+                response = self.run_after_hooks(self.after_hooks, request, response)
+            return response
+        if response is None:
+            response, validators = self.prepare(route, request, args, kwargs)
+            if response is None:
+                if route.cache is not None and request.method in ('GET', 'HEAD'):
+                    response = self.response_cache.fetch(
+                        route.cache.get_key(route, request), route.cache.ttl,
+                        lambda: self.call_route(route, request, args, kwargs, validators))
+                else:
+                    response = self.call_route(route, request, args, kwargs, validators)
+        if route.after_hooks:
+            response = self.run_after_hooks(route.after_hooks, request, response)
+        return response
+
+    def prepare(self, route, request, args, kwargs):
+        """Run the route before hooks, then its validator.
 
+        Return a (response, validators) tuple, response being set when
+        the view must not be called.
+        """
+        validators = None
+        try:
+            for hook in route.before_hooks:
+                response = hook(request)
+                if response is not None:
+                    return response, None
+            if route.validator is not None and request.method in ('GET', 'HEAD'):
+                validators = route.get_validators(request, *args, **kwargs)
+        except (exceptions.SpeweException,) as exception:
+            return self.error_response(exception), None
+        if validators and any(validators) and is_not_modified(request, *validators):
+            return route.set_validators(ResponseNotModified(), validators), None
+        return None, validators
+
+    def run_after_hooks(self, hooks, request, response):
+        for hook in hooks:
+            result = hook(request, response)
+            if result is not None:
+                response = result
+        return response
+
+    def run_teardown_hooks(self, request, exception):
+        for hook in self.teardown_hooks:
+            hook(request, exception)
+
+    def call_route(self, route, request, args, kwargs, validators=None):
         try:
             response = route(request, *args, **kwargs)
-            if response is None:
-                return ResponseNoContent()
         except (exceptions.SpeweException,) as exception:
-            return Response(data=exception.args[0],
-                            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            return self.error_response(exception)
+        return self.complete_response(route, response, validators)
+
+    def mark_timing(self, request, phase):
+        timing = request.environ.get('spewe.timing')
+        if timing is not None:
+            timing.mark(phase)
+
+    def set_timing_route(self, request, name):
+        timing = request.environ.get('spewe.timing')
+        if timing is not None:
+            timing.route = name
+
+    def resolve(self, request, args, kwargs):
+        """Run everything preceding the route hooks.
+
+        Return a (response, route) tuple, route being None when no view
+        is involved, and response being set when it must be sent without
+        calling the view, like a cached one: the route after hooks still
+        apply to it.
+        """
+        if self.stats is not None and request.path == self.settings.STATS_URL:
+            return JsonResponse(self.stats.summary()), None
+
+        max_body_size = self.settings.MAX_BODY_SIZE
+        if max_body_size is not None and (request.get_content_length() or 0) > max_body_size:
+            return self.error_response(exceptions.RequestEntityTooLarge()), None
+
+        if self.static is not None and self.static.match(request.path):
+            if self.stats is not None:
+                self.set_timing_route(request, 'static')
+            return self.static(request), None
+
+        match = self.router.match(request.path)
+        if match is None:
+            return Response(data='Page not found', status_code=status.HTTP_404_NOT_FOUND), None
+
+        route = match.route
+        if self.stats is not None:
+            self.set_timing_route(request, route.name)
+        if request.method.lower() not in match.methods:
+            response = Response(data='Method not allowed', status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+            response.add_header('Allow', ', '.join(sorted(match.methods)).upper())
+            return response, None
+
+        if match.params:
+            kwargs.update(match.params)
+
+        # hits of routes with before hooks are only served once they passed
+        if route.cache is not None and request.method in ('GET', 'HEAD') and not route.before_hooks:
+            response = self.response_cache.get(route.cache.get_key(route, request))
+            if response is not None:
+                return response, route
+        return None, route
+
+    def complete_response(self, route, response, validators=None):
+        if response is None:
+            return ResponseNoContent()
+        if validators and response.status_code == 200:
+            route.set_validators(response, validators)
         return response
 
-    def route(self, url, methods=['GET'], name=None, template=None):
+    def error_response(self, exception):
+        message = exception.args[0] if exception.args else getattr(exception, 'status_message', '')
+        return Response(data=message,
+                        status_code=getattr(exception, 'status_code', status.HTTP_500_INTERNAL_SERVER_ERROR))
+
+    def route(self, url, methods=['GET'], name=None, template=None, validator=None, cache=None,
+              before=None, after=None):
+        """Register a view for url, either a function or a coroutine function.
+
+        `validator` is an optional callable taking the view arguments and
+        returning an (etag, last_modified) tuple, last_modified being a
+        timestamp or a datetime. When the client copy is still fresh, a 304
+        is sent without calling the view.
+        `cache` is a number of seconds or a CachePolicy: GET and HEAD
+        responses are then kept and sent again without calling the view.
+        `before` and `after` are lists of hooks of the route only, run
+        after the app before_request hooks and before its after_request
+        ones.
+        """
         methods = [method.lower() for method in methods]
+        if cache is not None and not isinstance(cache, CachePolicy):
+            cache = CachePolicy(cache)
 
         def add_route(func):
-            route = Route(url, methods, func, name, template)
+            route = Route(url, methods, func, name, template, validator, cache, before, after)
             route.app = self
-            self.routes.append(route)
+            self.router.add(route)
+            self.build_hooks()
         return add_route
 
+    def before_request(self, func):
+        """Register func(request), called before the views. When it
+        returns a response, the view isn't called.
+        """
+        self._before.append(func)
+        self.build_hooks()
+        return func
+
+    def after_request(self, func):
+        """Register func(request, response), called with every response.
+        A response returned by it replaces the original one.
+        """
+        self._after.append(func)
+        self.build_hooks()
+        return func
+
+    def teardown(self, func):
+        """Register func(request, exception), called once the response
+        is sent or the request failed with exception. Streamed bodies are
+        torn down when the server closes them.
+        """
+        self._teardown.append(func)
+        self.build_hooks()
+        return func
+
+    def build_hooks(self):
+        """Flatten the app and route hooks into a tuple per route, so that
+        requests only go through them
+        """
+        self.after_hooks = tuple(self._after)
+        self.teardown_hooks = tuple(self._teardown)
+        for route in self.routes:
+            route.before_hooks = tuple(self._before) + route.before
+            route.after_hooks = route.after + self.after_hooks
+
 
 class Route(object):
 
-    def __init__(self, url, methods, view, name=None, template=None):
+    def __init__(self, url, methods, view, name=None, template=None, validator=None, cache=None,
+                 before=None, after=None):
         self.url = url
         self.methods = methods
         self.view = view
         self.name = name if name else view.__name__
-        self.match = None
         self._template = template
+        self.validator = validator
+        self.cache = cache
+        self.before = tuple(before or ())
+        self.after = tuple(after or ())
+        self.before_hooks = self.before
+        self.after_hooks = self.after
+        self.is_async = iscoroutinefunction(view)
 
     def __unicode__(self):
         return u'%s - %s - %s' % (self.methods, self.url, self.view)
@@ -129,30 +442,56 @@ class Route(object):
         return os.path.join(self.app.settings.TEMPLATE_DIR, self._template) if self._template else None
 
     def url_match(self, request):
-        match = re.match(self.url, request.path)
-        if not match:
-            return False
-        # capture url params
-        if getattr(match, 'groupdict'):
-            self.match = match.groupdict()
-        return match
+        return re.match(self.url, request.path)
+
+    def get_validators(self, request, *args, **kwargs):
+        etag, last_modified = self.validator(request, *args, **kwargs)
+        if isinstance(last_modified, datetime.datetime):
+            last_modified = calendar.timegm(last_modified.utctimetuple())
+        if etag and not etag.startswith(('"', 'W/"')):
+            etag = '"%s"' % etag
+        return etag, last_modified
+
+    def set_validators(self, response, validators):
+        etag, last_modified = validators
+        if etag and not response.headers.get('ETag'):
+            response.add_header('ETag', etag)
+        if last_modified is not None and not response.headers.get('Last-Modified'):
+            response.add_header('Last-Modified', http_date(last_modified))
+        return response
 
     def is_method_allowed(self, method):
         return method.lower() in self.methods
 
     def __call__(self, request, *args, **kwargs):
-        if self.match:
-            kwargs.update(self.match)
+        result = self.call_view(request, *args, **kwargs)
+        if self.is_async:
+            from spewe.asgi import run_coroutine
+            result = run_coroutine(result)
+        return self.make_response(request, result)
+
+    def call_view(self, request, *args, **kwargs):
+        """Call the view and return its result as is, a coroutine for
+        async views
+        """
         if self.template:
             kwargs.setdefault('context', {'request': request})
-        response = self.view(request, *args, **kwargs)
+        return self.view(request, *args, **kwargs)
+
+    def make_response(self, request, response):
+        timing = request.environ.get('spewe.timing') if self.app.stats is not None else None
+        if timing is not None:
+            timing.mark('view')
         if isinstance(response, str):
             return Response(response)
         if isinstance(response, (TemplateResponse,)):
             try:
                 response.context.setdefault('request', request)
                 response.context.setdefault('app', self.app)
-                response = Response(render_template(self.template, response.context))
+                response = Response(render_template(self.template, response.context,
+                                                    loader=self.app.template_loader))
+                if timing is not None:
+                    timing.mark('render')
             except (exceptions.TemplateNotFound,) as exc:
                 response = Response(
                     data=exc.args[0], status_code=exc.status_code)
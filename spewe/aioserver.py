@@ -0,0 +1,345 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import asyncio
+import socket
+import traceback
+from urllib.parse import unquote, urlsplit
+
+from spewe.multipart import CHUNK_SIZE
+from spewe.status import status
+
+try:
+    current_task = asyncio.current_task
+except (AttributeError,):
+    current_task = asyncio.Task.current_task
+
+
+class HttpError(Exception):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        super(HttpError, self).__init__(status.describe(status_code))
+
+
+def error_message(status_code):
+    return ('HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+            % status.describe(status_code)).encode('latin-1')
+
+
+class HttpConnection(object):
+    """A client connection, its requests being read and answered in
+    order: pipelined requests wait in the reader buffer
+    """
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.keep_alive = True
+
+    async def serve(self):
+        timeout = self.server.header_timeout
+        while self.keep_alive:
+            try:
+                head = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), timeout)
+            except (asyncio.LimitOverrunError,):
+                self.writer.write(error_message(431))
+                return
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                return
+            # the header timeout only applies to the first request
+            timeout = self.server.keepalive_timeout
+            try:
+                scope = self.parse_head(head)
+            except (HttpError,) as exc:
+                self.writer.write(error_message(exc.status_code))
+                return
+            await self.handle_request(scope)
+            await self.writer.drain()
+
+    def parse_head(self, head):
+        lines = head.lstrip(b'\r\n')[:-4].split(b'\r\n')
+        try:
+            method, target, version = lines[0].decode('latin-1').split(' ')
+        except (ValueError,):
+            raise HttpError(status.HTTP_400_BAD_REQUEST)
+        if version not in ('HTTP/1.1', 'HTTP/1.0'):
+            raise HttpError(505)
+        headers, fields = [], {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(b':')
+            if not sep or not name or name != name.strip():
+                raise HttpError(status.HTTP_400_BAD_REQUEST)
+            name, value = name.lower(), value.strip()
+            headers.append((name, value))
+            fields[name] = fields[name] + b',' + value if name in fields else value
+
+        self.method = method
+        self.version = version
+        self.chunked = False
+        self.remaining = 0
+        self.chunk_left = 0
+        if b'transfer-encoding' in fields:
+            # both framings at once is how requests get smuggled
+            if b'content-length' in fields or not fields[b'transfer-encoding'].lower().endswith(b'chunked'):
+                raise HttpError(status.HTTP_400_BAD_REQUEST)
+            self.chunked = True
+        elif b'content-length' in fields:
+            try:
+                lengths = set(int(length) for length in fields[b'content-length'].split(b','))
+            except (ValueError,):
+                raise HttpError(status.HTTP_400_BAD_REQUEST)
+            if len(lengths) != 1 or min(lengths) < 0:
+                raise HttpError(status.HTTP_400_BAD_REQUEST)
+            self.remaining = lengths.pop()
+        self.body_done = not (self.chunked or self.remaining)
+        self.body_received = False
+        self.expect_continue = version == 'HTTP/1.1' and fields.get(b'expect', b'').lower() == b'100-continue'
+
+        connection = fields.get(b'connection', b'').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = b'close' not in connection
+        else:
+            self.keep_alive = b'keep-alive' in connection
+
+        if target.startswith(('http://', 'https://')):
+            parts = urlsplit(target)
+            target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        path, _, query = target.partition('?')
+        server = self.writer.get_extra_info('sockname') or ('localhost', 80)
+        return {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': version[5:],
+            'method': method,
+            'scheme': 'http',
+            'path': unquote(path, errors='replace'),
+            'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'),
+            'root_path': '',
+            'headers': headers,
+            'server': tuple(server[:2]),
+            'client': tuple((self.writer.get_extra_info('peername') or ('', 0))[:2]),
+        }
+
+    async def handle_request(self, scope):
+        self.response_status = None
+        self.response_headers = None
+        self.started = self.finished = False
+        self.response_done = asyncio.Event()
+        try:
+            await self.server.handler(scope, self.receive, self.send)
+            if not self.started:
+                raise RuntimeError('no response sent')
+        except (Exception,):
+            traceback.print_exc()
+            self.keep_alive = False
+            if not self.started:
+                self.response_status, self.response_headers = 500, []
+                await self.send({'type': 'http.response.body', 'body': b'Internal Server Error'})
+        finally:
+            self.response_done.set()
+        if not (self.finished and self.body_done):
+            # the connection state is unknown
+            self.keep_alive = False
+
+    async def receive(self):
+        if self.body_received:
+            await self.response_done.wait()
+            return {'type': 'http.disconnect'}
+        if self.body_done:
+            self.body_received = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        if self.expect_continue:
+            self.expect_continue = False
+            self.writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        try:
+            body = await asyncio.wait_for(self.read_body(), self.server.body_timeout)
+        except (HttpError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ConnectionError):
+            self.keep_alive = False
+            self.body_received = True
+            return {'type': 'http.disconnect'}
+        self.body_received = self.body_done
+        return {'type': 'http.request', 'body': body, 'more_body': not self.body_done}
+
+    async def read_body(self):
+        reader = self.reader
+        if not self.chunked:
+            data = await reader.readexactly(min(self.remaining, CHUNK_SIZE))
+            self.remaining -= len(data)
+            self.body_done = not self.remaining
+            return data
+        if not self.chunk_left:
+            line = await reader.readuntil(b'\r\n')
+            try:
+                self.chunk_left = int(line.split(b';', 1)[0].strip(), 16)
+            except (ValueError,):
+                raise HttpError(status.HTTP_400_BAD_REQUEST)
+            if self.chunk_left < 0:
+                raise HttpError(status.HTTP_400_BAD_REQUEST)
+            if not self.chunk_left:
+                # skip the trailers
+                while await reader.readuntil(b'\r\n') != b'\r\n':
+                    pass
+                self.body_done = True
+                return b''
+        data = await reader.readexactly(min(self.chunk_left, CHUNK_SIZE))
+        self.chunk_left -= len(data)
+        if not self.chunk_left and await reader.readexactly(2) != b'\r\n':
+            raise HttpError(status.HTTP_400_BAD_REQUEST)
+        return data
+
+    def format_head(self, body, more_body):
+        code = self.response_status
+        headers = list(self.response_headers)
+        names = set(name.lower() for name, _ in headers)
+        self.send_body = self.method != 'HEAD' and code >= 200 and code not in (204, 304)
+        self.chunked_response = False
+        if self.send_body and not names.intersection((b'content-length', b'transfer-encoding')):
+            if not more_body:
+                headers.append((b'content-length', str(len(body)).encode('latin-1')))
+            elif self.version == 'HTTP/1.1':
+                headers.append((b'transfer-encoding', b'chunked'))
+                self.chunked_response = True
+            else:
+                # the end of the body is the end of the connection
+                self.keep_alive = False
+        if not self.body_done:
+            self.keep_alive = False
+        if b'connection' in names:
+            self.keep_alive = self.keep_alive and b'close' not in dict(headers)[b'connection'].lower()
+            headers = [(name, value) for name, value in headers if name.lower() != b'connection']
+        if not self.keep_alive:
+            headers.append((b'connection', b'close'))
+        elif self.version == 'HTTP/1.0':
+            headers.append((b'connection', b'keep-alive'))
+        lines = [b'HTTP/1.1 ' + status.describe(code).encode('latin-1')]
+        lines.extend(name + b': ' + value for name, value in headers)
+        lines.append(b'\r\n')
+        return b'\r\n'.join(lines)
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            self.response_status = message['status']
+            self.response_headers = message.get('headers', [])
+            return
+        if message['type'] != 'http.response.body' or self.finished:
+            return
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        data = b''
+        if not self.started:
+            self.started = True
+            data = self.format_head(body, more_body)
+        if not self.send_body:
+            body = b''
+        elif self.chunked_response:
+            body = (b'%x\r\n%s\r\n' % (len(body), body) if body else b'') + (b'' if more_body else b'0\r\n\r\n')
+        if data or body:
+            self.writer.write(data + body)
+        if not more_body:
+            self.finished = True
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncioServer(object):
+    """HTTP/1.1 server on asyncio streams, going through the app ASGI
+    handler.
+
+    Connections are kept alive between requests and pipelined requests
+    are answered in order. Streaming responses of unknown length are sent
+    chunked. Past `max_connections`, clients get a 503.
+    """
+
+    def __init__(self, app, server_name='localhost', port=8099, backlog=None,
+                 max_connections=1000, header_timeout=10, body_timeout=30,
+                 keepalive_timeout=5, max_header_size=64 * 1024):
+        self.app = app
+        self.handler = app.asgi
+        self.address = (server_name, port)
+        self.backlog = backlog or 100
+        self.max_connections = max_connections
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_header_size = max_header_size
+        self.connections = set()
+        self.server = None
+        self.loop = None
+
+    @property
+    def server_port(self):
+        return self.server.sockets[0].getsockname()[1] if self.server else None
+
+    async def start(self):
+        if hasattr(self.app, 'warmup'):
+            self.app.warmup()
+        self.server = await asyncio.start_server(
+            self.handle_connection, self.address[0], self.address[1],
+            backlog=self.backlog, limit=self.max_header_size)
+
+    async def handle_connection(self, reader, writer):
+        if len(self.connections) >= self.max_connections:
+            writer.write(error_message(status.HTTP_503_SERVICE_UNAVAILABLE))
+            writer.close()
+            return
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = HttpConnection(self, reader, writer)
+        connection.task = current_task()
+        self.connections.add(connection)
+        try:
+            await connection.serve()
+        except (ConnectionError,):
+            pass
+        finally:
+            self.connections.discard(connection)
+            connection.close()
+
+    async def close(self):
+        self.server.close()
+        tasks = []
+        for connection in list(self.connections):
+            connection.task.cancel()
+            tasks.append(connection.task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def serve_forever(self):
+        self.loop = loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.start())
+            loop.run_forever()
+        except (KeyboardInterrupt,):
+            pass
+        finally:
+            if self.server is not None:
+                loop.run_until_complete(self.close())
+            loop.close()
+
+    def shutdown(self):
+        """Stop serve_forever, from any thread"""
+        self.loop.call_soon_threadsafe(self.loop.stop)
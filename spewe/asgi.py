@@ -0,0 +1,267 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from spewe.exceptions import RequestEntityTooLarge, SpeweException
+from spewe.http import Request, StreamingResponse
+from spewe.stats import Timing
+
+
+def run_coroutine(coroutine):
+    """Run a coroutine to completion on a private event loop, for async
+    views served over wsgi
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def build_environ(scope, body):
+    """Build a wsgi environ from an http scope and the request body"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or ''),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'asgi.scope': scope,
+    }
+    for name, value in scope.get('headers', ()):
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        value = value.decode('latin-1')
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+
+async def read_body(receive, max_size=None):
+    """Read the whole request body from receive, None when the client
+    went away
+    """
+    chunks, size, more_body = [], 0, True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise RequestEntityTooLarge()
+        chunks.append(chunk)
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+class ASGIHandler(object):
+    """Serve a Spewe application over ASGI 3.
+
+    Coroutine views are awaited on the event loop, plain views run in a
+    pool of `ASGI_THREADS` threads, the loop default executor if unset.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        threads = app.settings.ASGI_THREADS
+        self.executor = ThreadPoolExecutor(threads) if threads else None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+        else:
+            raise SpeweException('unsupported scope type %s' % scope['type'])
+
+    def run_sync(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    self.app.warmup()
+                except (Exception,) as exc:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(exc)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle_http(self, scope, receive, send):
+        app = self.app
+        max_body_size = app.settings.MAX_BODY_SIZE
+        response = None
+        timing = Timing() if app.stats is not None else None
+        try:
+            body = await read_body(receive, max_body_size)
+        except (RequestEntityTooLarge,) as exception:
+            body, response = b'', app.error_response(exception)
+        if body is None:
+            return
+        environ = build_environ(scope, body)
+        request = Request(environ, max_body_size=max_body_size)
+        if timing is not None:
+            environ['spewe.timing'] = timing
+            timing.mark('request')
+        try:
+            if response is None:
+                response = await self.get_response(request)
+            response = app.finalize(request, response)
+        except (Exception,) as exception:
+            if app.teardown_hooks:
+                app.run_teardown_hooks(request, exception)
+            raise
+        if timing is not None:
+            app.record_timing(timing, response)
+        try:
+            await self.send_response(request, response, send)
+        except (Exception,) as exception:
+            if app.teardown_hooks:
+                app.run_teardown_hooks(request, exception)
+            raise
+        if app.teardown_hooks:
+            app.run_teardown_hooks(request, None)
+
+    async def get_response(self, request):
+        app = self.app
+        kwargs = {}
+        response, route = app.resolve(request, (), kwargs)
+        if app.stats is not None:
+            app.mark_timing(request, 'routing')
+        if route is None:
+            if app.after_hooks:
+                response = app.run_after_hooks(app.after_hooks, request, response)
+            return response
+        if response is None:
+            response, validators = app.prepare(route, request, (), kwargs)
+            if response is None:
+                if route.cache is not None and request.method in ('GET', 'HEAD'):
+                    response = await self.fetch(route.cache.get_key(route, request), route.cache.ttl,
+                                                partial(self.call_route, route, request, kwargs, validators))
+                else:
+                    response = await self.call_route(route, request, kwargs, validators)
+        if route.after_hooks:
+            response = app.run_after_hooks(route.after_hooks, request, response)
+        return response
+
+    async def call_route(self, route, request, kwargs, validators=None):
+        try:
+            if route.is_async:
+                response = route.make_response(request, await route.call_view(request, **kwargs))
+            else:
+                response = await self.run_sync(route, request, **kwargs)
+        except (SpeweException,) as exception:
+            return self.app.error_response(exception)
+        return self.app.complete_response(route, response, validators)
+
+    async def fetch(self, key, ttl, create):
+        """ResponseCache.fetch, waiting on the event loop"""
+        cache = self.app.response_cache
+        while True:
+            response = cache.get(key)
+            if response is not None:
+                return response
+            event, owner = cache.claim(key)
+            if owner:
+                break
+            waited = 0
+            while not event.is_set() and waited < cache.wait_timeout:
+                await asyncio.sleep(0.01)
+                waited += 0.01
+            if not event.is_set():
+                return await create()
+        try:
+            response = await create()
+            cache.set(key, response, ttl)
+            return response
+        finally:
+            cache.release(key, event)
+
+    async def send_response(self, request, response, send):
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                   for name, value in response.headerlist]
+        start = {'type': 'http.response.start', 'status': response.status_code, 'headers': headers}
+        send_body = request.method != 'HEAD'
+
+        if isinstance(response, StreamingResponse) and hasattr(response.data, '__aiter__'):
+            await send(start)
+            try:
+                async for chunk in response.data:
+                    if not isinstance(chunk, bytes):
+                        chunk = chunk.encode(response.charset)
+                    if chunk and send_body:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            finally:
+                aclose = getattr(response.data, 'aclose', None)
+                if aclose is not None:
+                    await aclose()
+            await send({'type': 'http.response.body'})
+            return
+
+        body = response.get_body(request.environ)
+        if type(body) is list:
+            content = b''.join(body)
+            if response.status_code not in (204, 304) and not response.get_header('Content-Length'):
+                headers.append((b'content-length', str(len(content)).encode('latin-1')))
+            await send(start)
+            await send({'type': 'http.response.body', 'body': content if send_body else b''})
+            return
+
+        # other iterables, files among them, may block: they are consumed
+        # in the thread pool
+        await send(start)
+        try:
+            if send_body:
+                iterator = iter(body)
+                while True:
+                    chunk = await self.run_sync(next, iterator, None)
+                    if chunk is None:
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            close = getattr(body, 'close', None)
+            if close is not None:
+                close()
+        await send({'type': 'http.response.body'})
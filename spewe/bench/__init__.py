@@ -0,0 +1,196 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Micro and end-to-end benchmarks of Spewe.
+
+Run them with `python -m spewe.bench`, see `--help`.
+"""
+import json
+import platform
+import sys
+import time
+from collections import OrderedDict
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# benchmark name -> setup function returning the callable to time
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """Register a setup function under name"""
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def percentile(values, rank):
+    """Nearest-rank percentile of sorted values"""
+    index = int(round(rank / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def calibrate(func, sample_time):
+    """Number of calls making a sample of about sample_time seconds"""
+    batch = 1
+    while True:
+        start = timer()
+        for _ in range(batch):
+            func()
+        elapsed = timer() - start
+        if elapsed >= sample_time or batch >= 1 << 20:
+            return max(1, int(batch * sample_time / elapsed)) if elapsed else batch
+        batch *= 2
+
+
+def measure(func, duration=1.0, sample_time=0.0001, warmup=0.1):
+    """Time func for about duration seconds.
+
+    Calls are timed in batches of about sample_time seconds, so that the
+    timer overhead doesn't show in sub-microsecond operations: latencies
+    are the mean call time of each batch.
+    """
+    batch = calibrate(func, sample_time)
+    deadline = timer() + warmup
+    while timer() < deadline:
+        func()
+    samples = []
+    calls = 0
+    deadline = timer() + duration
+    while True:
+        start = timer()
+        for _ in range(batch):
+            func()
+        end = timer()
+        samples.append((end - start) / batch)
+        calls += batch
+        if end >= deadline:
+            break
+    total = sum(samples) * batch
+    samples.sort()
+    return OrderedDict([
+        ('ops', calls / total if total else 0),
+        ('mean', total / calls),
+        ('p50', percentile(samples, 50)),
+        ('p90', percentile(samples, 90)),
+        ('p99', percentile(samples, 99)),
+        ('min', samples[0]),
+        ('max', samples[-1]),
+        ('calls', calls),
+        ('batch', batch),
+    ])
+
+
+def run(names=None, duration=1.0, report=None):
+    """Run the benchmarks (all of them when names is None) and return
+    their results, calling report(name, result) after each one
+    """
+    from spewe.bench import cases  # noqa, registers the benchmarks
+    results = OrderedDict()
+    for name, setup in BENCHMARKS.items():
+        if names is not None and not any(name.startswith(prefix) for prefix in names):
+            continue
+        func = setup()
+        try:
+            results[name] = measure(func, duration)
+        finally:
+            close = getattr(func, 'close', None)
+            if close is not None:
+                close()
+        if report is not None:
+            report(name, results[name])
+    return OrderedDict([
+        ('python', platform.python_implementation() + ' ' + platform.python_version()),
+        ('platform', platform.platform()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+        ('results', results),
+    ])
+
+
+def compare(baseline, results, threshold=0.1):
+    """Return the (name, baseline ops, ops, change) of the benchmarks
+    more than threshold slower than in baseline
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        previous = baseline['results'].get(name)
+        if not previous or not previous['ops']:
+            continue
+        change = result['ops'] / previous['ops'] - 1
+        if change < -threshold:
+            regressions.append((name, previous['ops'], result['ops'], change))
+    return regressions
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '%.2f%s' % (seconds / scale, unit)
+    return '%.0fns' % (seconds / 1e-9)
+
+
+def format_result(name, result):
+    return '%-40s %12.0f ops/s  p50 %9s  p90 %9s  p99 %9s' % (
+        name, result['ops'], format_time(result['p50']), format_time(result['p90']),
+        format_time(result['p99']))
+
+
+def save(results, path):
+    with open(path, 'w') as fp:
+        json.dump(results, fp, indent=2)
+
+
+def load(path):
+    with open(path) as fp:
+        return json.load(fp, object_pairs_hook=OrderedDict)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m spewe.bench', description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*', help='benchmark name prefixes, all of them by default')
+    parser.add_argument('-d', '--duration', type=float, default=1.0, help='seconds per benchmark')
+    parser.add_argument('-o', '--output', help='save the results as json to OUTPUT')
+    parser.add_argument('-c', '--compare', help='json results of a previous run')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='slowdown ratio reported as a regression (default: 0.1)')
+    parser.add_argument('-l', '--list', action='store_true', help='list the benchmarks')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        from spewe.bench import cases  # noqa
+        for name in BENCHMARKS:
+            print(name)
+        return 0
+
+    def report(name, result):
+        print(format_result(name, result))
+        sys.stdout.flush()
+
+    results = run(args.names or None, args.duration, report)
+    if args.output:
+        save(results, args.output)
+    if args.compare:
+        regressions = compare(load(args.compare), results, args.threshold)
+        for name, before, after, change in regressions:
+            print('REGRESSION %s: %.0f -> %.0f ops/s (%+.1f%%)' % (name, before, after, change * 100))
+        if regressions:
+            return 1
+    return 0
@@ -0,0 +1,204 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import io
+import shutil
+import tempfile
+import wsgiref.util
+
+from spewe import Spewe
+from spewe.bench import benchmark
+from spewe.http import JsonResponse, Request, TemplateResponse
+from spewe.template import Template
+
+
+def make_environ(path='/', method='GET', query='', body=b'', content_type=None):
+    environ = {'PATH_INFO': path, 'REQUEST_METHOD': method, 'QUERY_STRING': query,
+               'wsgi.input': io.BytesIO(body)}
+    if body:
+        environ['CONTENT_LENGTH'] = str(len(body))
+    if content_type:
+        environ['CONTENT_TYPE'] = content_type
+    wsgiref.util.setup_testing_defaults(environ)
+    return environ
+
+
+def make_app(count):
+    """An app with count routes, half literal and half with parameters"""
+    app = Spewe(settings={'STATIC_URL': None})
+
+    def view(request, **kwargs):
+        return 'ok'
+
+    for i in range(count // 2):
+        app.route('/users/%d/profile' % i, name='literal%d' % i)(view)
+        app.route(r'^/items%d/(?P<item_id>\d+)$' % i, name='param%d' % i)(view)
+    app.warmup()
+    return app
+
+
+def handle(count):
+    app = make_app(count)
+    # the last routes are the most expensive to reach
+    literal = Request(make_environ('/users/%d/profile' % (count // 2 - 1)))
+    param = Request(make_environ('/items%d/42' % (count // 2 - 1)))
+
+    def run():
+        app.handle(literal)
+        app.handle(param)
+    return run
+
+
+for count in (10, 100, 1000):
+    benchmark('routing.handle.%d' % count)(lambda count=count: handle(count))
+
+
+@benchmark('request.get')
+def request_get():
+    environ = make_environ('/search', query='q=spewe&page=2&sort=date')
+
+    def run():
+        request = Request(environ)
+        request.params
+        request.headers
+    return run
+
+
+def request_body(body, content_type, attribute):
+    environ = make_environ('/submit', 'POST', body=body, content_type=content_type)
+
+    def run():
+        environ['wsgi.input'] = io.BytesIO(body)
+        getattr(Request(environ), attribute)
+    return run
+
+
+@benchmark('request.urlencoded')
+def request_urlencoded():
+    body = b'&'.join(b'field%d=value+%d' % (i, i) for i in range(20))
+    return request_body(body, 'application/x-www-form-urlencoded', 'form')
+
+
+@benchmark('request.multipart')
+def request_multipart():
+    parts = [b'--boundary\r\nContent-Disposition: form-data; name="field%d"\r\n\r\nvalue %d\r\n' % (i, i)
+             for i in range(10)]
+    parts.append(b'--boundary\r\nContent-Disposition: form-data; name="file"; filename="data.bin"\r\n'
+                 b'Content-Type: application/octet-stream\r\n\r\n' + b'x' * 32 * 1024 + b'\r\n')
+    parts.append(b'--boundary--\r\n')
+    return request_body(b''.join(parts), 'multipart/form-data; boundary=boundary', 'form')
+
+
+@benchmark('request.json')
+def request_json():
+    body = b'{"users": [' + b','.join(
+        b'{"id": %d, "username": "user%d", "active": true}' % (i, i) for i in range(50)) + b']}'
+    return request_body(body, 'application/json', 'json')
+
+
+class Item(object):
+
+    def __init__(self, name, price):
+        self.name = name
+        self.price = price
+
+
+TEMPLATES = {
+    'small': ('<p>Hello {{ name }}</p>', {'name': 'spewe'}),
+    'large': (''.join('<div class="row%d"><h2>{{ title }}</h2><p>{{ name }} - %d</p>'
+                      '{%% if admin %%}<a href="/edit/%d">edit</a>{%% endif %%}</div>\n' % (i, i, i)
+                      for i in range(200)),
+              {'title': 'Spewe', 'name': 'kenny', 'admin': True}),
+    'loop': ('<ul>{% loop items %}{% if item.price > 10 %}<li>{{ item.name }}: {{ item.price }}</li>'
+             '{% else %}<li>{{ item.name }}</li>{% endif %}{% endloop %}</ul>',
+             {'items': [Item('item%d' % i, i % 20) for i in range(1000)]}),
+}
+
+
+def template_parse(content):
+    def run():
+        Template(content=content).compile()
+    return run
+
+
+def template_render(content, context):
+    template = Template(content=content)
+    template.compile()
+
+    def run():
+        template.render(context)
+    return run
+
+
+for size, (content, context) in TEMPLATES.items():
+    benchmark('template.parse.%s' % size)(lambda content=content: template_parse(content))
+    benchmark('template.render.%s' % size)(
+        lambda content=content, context=context: template_render(content, context))
+
+
+def wsgi(path, accept_encoding=None, **settings):
+    directory = tempfile.mkdtemp()
+    with open('%s/page.html' % directory, 'w') as fp:
+        fp.write(TEMPLATES['large'][0])
+    settings.update({'TEMPLATE_DIR': directory, 'STATIC_URL': None})
+    app = Spewe(settings=settings)
+
+    @app.route('/text')
+    def text(request):
+        return 'Hello world'
+
+    @app.route('/json')
+    def json(request):
+        return JsonResponse({'users': [{'id': i, 'name': 'user%d' % i} for i in range(20)]})
+
+    @app.route('/page', template='page.html')
+    def page(request, context):
+        context.update(TEMPLATES['large'][1])
+        return TemplateResponse(context)
+
+    app.warmup()
+    environ = make_environ(path)
+    if accept_encoding:
+        environ['HTTP_ACCEPT_ENCODING'] = accept_encoding
+
+    def start_response(status, headers):
+        pass
+
+    if accept_encoding:
+        # make sure the case measures what it's named after
+        sent = []
+        b''.join(app(dict(environ), lambda status, headers: sent.extend(headers)))
+        if 'Content-Encoding' not in dict(sent):
+            shutil.rmtree(directory)
+            raise ValueError('%s is not compressed' % path)
+
+    def run():
+        body = app(dict(environ), start_response)
+        for chunk in body:
+            pass
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+    run.close = lambda: shutil.rmtree(directory)
+    return run
+
+
+for path in ('/text', '/json', '/page', '/missing'):
+    benchmark('wsgi.%s' % path.strip('/'))(lambda path=path: wsgi(path))
+benchmark('wsgi.page.compressed')(lambda: wsgi('/page', accept_encoding='gzip', COMPRESSION=True))
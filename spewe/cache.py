@@ -0,0 +1,207 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from urllib.parse import parse_qsl
+except (ImportError,):
+    from urlparse import parse_qsl
+
+from spewe.http import BaseResponse, StreamingResponse
+
+
+class LRUCache(object):
+    """Thread safe in-memory store, bounded by the total size of its
+    values.
+
+    Least recently used entries are evicted first once `max_size` is
+    exceeded (or `max_entries`, when set), and entries set with a ttl
+    expire after that many seconds.
+    """
+
+    def __init__(self, max_size=32 * 1024 * 1024, max_entries=None):
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            value, size, expires = entry
+            if expires is not None and expires <= time.time():
+                self.size -= size
+                return default
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None, size=1):
+        """Store value for ttl seconds (forever if None), `size` being
+        its weight against max_size
+        """
+        if size > self.max_size:
+            return
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_size or (self.max_entries is not None and
+                                                len(self._entries) > self.max_entries):
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def evict(self, match):
+        """Remove the entries whose key match(key) is true"""
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                self.size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class CachePolicy(object):
+    """How a route responses are cached.
+
+    Responses are kept `ttl` seconds and keyed on the route, the method,
+    the path, the `query` parameters (the whole query string when None)
+    and the values of the request `headers`.
+    """
+
+    def __init__(self, ttl, query=None, headers=()):
+        self.ttl = ttl
+        self.query = query
+        self.headers = tuple('HTTP_' + name.upper().replace('-', '_') for name in headers)
+
+    def get_key(self, route, request):
+        environ = request.environ
+        query = request.query_string or ''
+        if self.query is not None:
+            params = parse_qsl(query, keep_blank_values=True)
+            query = tuple(sorted(param for param in params if param[0] in self.query))
+        headers = tuple(environ.get(name) for name in self.headers)
+        return (route.name, request.method, request.path, query, headers)
+
+
+def is_cacheable(response):
+    if response.status_code != 200 or isinstance(response, StreamingResponse):
+        return False
+    if response.get_header('Set-Cookie'):
+        return False
+    cache_control = (response.get_header('Cache-Control') or '').lower()
+    return 'no-store' not in cache_control and 'private' not in cache_control
+
+
+class ResponseCache(object):
+    """Cache of encoded route responses.
+
+    A single caller regenerates a missing entry at a time: the others
+    wait up to `wait_timeout` seconds for it to be stored.
+    """
+
+    wait_timeout = 10
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else LRUCache()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self.store.get(key)
+        if entry is None:
+            return None
+        status_code, headerlist, content = entry
+        response = BaseResponse(content, status_code=status_code)
+        response.headerlist = list(headerlist)
+        return response
+
+    def set(self, key, response, ttl):
+        if not is_cacheable(response):
+            return
+        content = response.content
+        headerlist = tuple(response.headerlist)
+        size = len(content) + sum(len(name) + len(value) for name, value in headerlist)
+        self.store.set(key, (response.status_code, headerlist, content), ttl=ttl, size=size)
+
+    def claim(self, key):
+        """Return (event, owner), owner being True when the caller must
+        regenerate the entry and release it, else event is set once it's
+        done
+        """
+        with self._lock:
+            event = self._pending.get(key)
+            if event is not None:
+                return event, False
+            event = self._pending[key] = threading.Event()
+            return event, True
+
+    def release(self, key, event):
+        with self._lock:
+            self._pending.pop(key, None)
+        event.set()
+
+    def fetch(self, key, ttl, create):
+        """Return the cached response for key, or the one returned by
+        create(), stored for ttl seconds
+        """
+        while True:
+            response = self.get(key)
+            if response is not None:
+                return response
+            event, owner = self.claim(key)
+            if owner:
+                break
+            if not event.wait(self.wait_timeout):
+                return create()
+        try:
+            response = create()
+            self.set(key, response, ttl)
+            return response
+        finally:
+            self.release(key, event)
+
+    def invalidate(self, route_name):
+        """Drop the cached responses of the route named route_name"""
+        self.store.evict(lambda key: key[0] == route_name)
+
+    def clear(self):
+        self.store.clear()
@@ -0,0 +1,156 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import gzip
+import io
+import zlib
+
+try:
+    import brotli
+except (ImportError,):
+    brotli = None
+
+from spewe.http import ClosingIterator, StreamingResponse, parse_accept_encoding
+
+
+# content types not worth compressing again
+COMPRESSED_TYPES = ('image/', 'video/', 'audio/', 'font/woff', 'application/zip',
+                    'application/gzip', 'application/x-gzip', 'application/x-bzip2',
+                    'application/x-7z-compressed', 'application/x-rar-compressed',
+                    'application/octet-stream', 'application/pdf')
+
+
+class ZlibCompressor(object):
+
+    def __init__(self, encoding, level):
+        # gzip container for gzip, zlib container for deflate
+        wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor(object):
+
+    def __init__(self, encoding, level):
+        self._compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def get_compressors():
+    compressors = []
+    if brotli is not None:
+        compressors.append(('br', BrotliCompressor))
+    compressors.extend([('gzip', ZlibCompressor), ('deflate', ZlibCompressor)])
+    return compressors
+
+
+COMPRESSORS = get_compressors()
+
+
+def compress(data, encoding, level=6):
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    if encoding == 'gzip':
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as fp:
+            fp.write(data)
+        return buf.getvalue()
+    return zlib.compress(data, level)
+
+
+def compress_chunks(chunks, compressor):
+    # flush after each chunk so that streamed content isn't held back
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def is_compressible(response):
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return False
+    if response.get_header('Content-Encoding'):
+        return False
+    content_type = (response.get_header('Content-Type') or '').lower()
+    return bool(content_type) and not content_type.startswith(COMPRESSED_TYPES)
+
+
+def compress_response(request, response, min_size=500, level=6):
+    """Compress the response according to the request Accept-Encoding.
+
+    Buffered responses smaller than min_size are sent as is, streaming
+    responses are compressed as they are consumed.
+    """
+    if not is_compressible(response):
+        return response
+    streaming = isinstance(response, StreamingResponse)
+    if streaming and hasattr(response.data, '__aiter__'):
+        # async iterables are consumed as is by the asgi handler
+        return response
+    if not streaming:
+        content = response.content
+        if len(content) < min_size:
+            return response
+    vary = response.headers.get('Vary')
+    if not vary:
+        response.headers['Vary'] = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower():
+        response.headers['Vary'] = vary + ', Accept-Encoding'
+
+    accepted = parse_accept_encoding(request.headers.get('HTTP_ACCEPT_ENCODING'))
+    for encoding, compressor_class in COMPRESSORS:
+        if encoding in accepted:
+            break
+    else:
+        return response
+
+    del response.headers['Content-Length']
+    response.headers['Content-Encoding'] = encoding
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        # not byte for byte the same representation anymore
+        response.headers['ETag'] = 'W/' + etag
+    if not streaming:
+        response.data = compress(content, encoding, level)
+        return response
+    chunks = response.get_body()
+    compressed = StreamingResponse(
+        ClosingIterator(compress_chunks(chunks, compressor_class(encoding, level)),
+                        close=getattr(chunks, 'close', None)),
+        status_code=response.status_code)
+    compressed.headerlist = response.headerlist
+    compressed.cookies = response.cookies
+    return compressed
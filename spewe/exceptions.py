@@ -17,13 +17,18 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-from spewe.http import status
+from spewe.status import status
 
 
 class SpeweException(Exception):
     pass
 
 
+class BadRequest(SpeweException):
+    status_code = status.HTTP_400_BAD_REQUEST
+    status_message = 'Bad request'
+
+
 class Http404(SpeweException):
     status_code = status.HTTP_404_NOT_FOUND
     status_message = 'Page not found'
@@ -39,6 +44,11 @@ class MethodNotAllowed(SpeweException):
     status_message = 'Method not allowed'
 
 
+class RequestEntityTooLarge(SpeweException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    status_message = 'Request entity too large'
+
+
 class TemplateError(SpeweException):
 
     error_message = ''
@@ -56,6 +66,21 @@ class TemplateNotFound(TemplateError):
 class TemplateSyntaxError(TemplateError):
 
     error_message = 'invalid syntax in statement: {}'
+    name = lineno = col = None
+
+    def locate(self, name=None, lineno=None, col=None):
+        """Set the location of the error, when still unknown"""
+        if self.name is None:
+            self.name = name
+        if self.lineno is None:
+            self.lineno, self.col = lineno, col
+        return self
+
+    def __str__(self):
+        message = super(TemplateSyntaxError, self).__str__()
+        if self.lineno is None:
+            return message
+        return '%s (%s, line %d, column %d)' % (message, self.name or '<template>', self.lineno, self.col)
 
 
 class TemplateContextError(TemplateError):
@@ -17,8 +17,6 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-import cgi
-
 try:
     from http.cookies import SimpleCookie
 except (ImportError,):
@@ -29,55 +27,177 @@ try:
 except (ImportError,):
     from urlparse import parse_qs, urljoin
 
-import json
+import calendar
+import datetime
+import hashlib
+import io
+import mimetypes
+import os
+import time
 import wsgiref
+from email.utils import formatdate, mktime_tz, parsedate_tz
 from wsgiref.headers import Headers
 
+from spewe import serializers
+from spewe.exceptions import RequestEntityTooLarge, SpeweException
+from spewe.multipart import (CHUNK_SIZE, MultipartParser, XFormFile, iter_stream,  # noqa
+                             parse_options_header, parse_urlencoded)
+from spewe.status import HttpStatus, status  # noqa
 
-HTTP_SAFE_METHODS = ['HEAD', 'GET', 'OPTIONS']
 
+HTTP_SAFE_METHODS = ['HEAD', 'GET', 'OPTIONS']
 
-class HttpStatus(object):
 
-    def __init__(self):
-        self._statuses = {}
+# headers kept on a 304 response
+NOT_MODIFIED_HEADERS = ('ETag', 'Last-Modified', 'Cache-Control', 'Content-Location',
+                        'Expires', 'Vary')
+
+
+def http_date(value):
+    """Format a timestamp or a datetime as an HTTP date"""
+    if isinstance(value, datetime.datetime):
+        value = calendar.timegm(value.utctimetuple())
+    return formatdate(value, usegmt=True)
+
+
+def parse_http_date(value):
+    try:
+        return mktime_tz(parsedate_tz(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def is_not_modified(request, etag=None, last_modified=None):
+    """Check the request conditional headers against the validators.
+    `last_modified` is a timestamp.
+    """
+    if_none_match = request.headers.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        if not etag:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        # weak comparison
+        etag = etag[2:] if etag.startswith('W/') else etag
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+    if_modified_since = request.headers.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        since = parse_http_date(if_modified_since)
+        return since is not None and int(last_modified) <= since
+    return False
+
+
+def conditional_response(request, response, add_etag=False):
+    """Turn a 200 response to a GET/HEAD request into a 304 when the
+    client copy is fresh. With add_etag, buffered responses without ETag
+    get one from a hash of their content.
+    """
+    if response.status_code != 200 or request.method not in ('GET', 'HEAD'):
+        return response
+    etag = response.get_header('ETag')
+    if etag is None and add_etag and not isinstance(response, StreamingResponse):
+        etag = '"%s"' % hashlib.sha1(response.content).hexdigest()
+        response.add_header('ETag', etag)
+    last_modified = response.get_header('Last-Modified')
+    if last_modified is not None:
+        last_modified = parse_http_date(last_modified)
+    if (etag or last_modified is not None) and is_not_modified(request, etag, last_modified):
+        not_modified = ResponseNotModified(headers=response.headerlist)
+        response.close()
+        return not_modified
+    return response
+
+
+_now = (0, '')
+
+
+def http_now():
+    """The current HTTP date, formatted at most once per second"""
+    global _now
+    now = int(time.time())
+    if _now[0] != now:
+        _now = (now, formatdate(now, usegmt=True))
+    return _now[1]
+
+
+def parse_accept_encoding(value):
+    """Return the set of encodings accepted by an Accept-Encoding header"""
+    accepted = set()
+    for item in (value or '').split(','):
+        encoding, _, params = item.partition(';')
+        encoding = encoding.strip().lower()
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, param_value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(param_value)
+                except (ValueError,):
+                    quality = 0
+        if encoding and quality > 0:
+            accepted.add(encoding)
+    return accepted
+
+
+class lazy_property(object):
+    """Compute the value on first access and keep it in the `_<name>` slot
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.slot = '_' + func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
         try:
-            from http.server import HTTPStatus
-            self._statuses = {status.value: status.phrase for status in HTTPStatus}
-        except (ImportError,):
-            import httplib
-            self._statuses = httplib.responses
-        for value, phrase in self._statuses.items():
-            phrase = 'HTTP_%d_%s' % (value, phrase.upper().replace(' ', '_'))
-            setattr(self, phrase, value)
-
-    def describe(self, status_code):
-        return '%d %s' % (status_code, self._statuses[status_code].upper())
-
-
-status = HttpStatus()
-
-
-class XFormFile(object):
-
-    def __init__(self, filename, content, content_type=None, encoding=None):
-        self.filename = filename
-        self.content = content.decode()
-        self.content_type = content_type
-        self.encoding = encoding
-
-    def __repr__(self):
-        return '<XFormFile: %s>' % self.filename
+            return getattr(instance, self.slot)
+        except (AttributeError,):
+            value = self.func(instance)
+            setattr(instance, self.slot, value)
+            return value
+
+
+class LimitedStream(object):
+    """Read at most `limit` bytes from a wsgi.input stream, and raise
+    RequestEntityTooLarge past `max_size` bytes
+    """
+
+    def __init__(self, stream, limit=None, max_size=None):
+        self.stream = stream
+        self.limit = limit
+        self.max_size = max_size
+        self.position = 0
+
+    def read(self, size=-1):
+        if self.limit is not None:
+            remaining = self.limit - self.position
+            if remaining <= 0:
+                return b''
+            size = remaining if size is None or size < 0 else min(size, remaining)
+        chunk = self.stream.read(size) if size is not None and size >= 0 else self.stream.read()
+        self.position += len(chunk)
+        if self.max_size is not None and self.position > self.max_size:
+            raise RequestEntityTooLarge()
+        return chunk
 
 
 class Request(object):
 
-    def __init__(self, env):
+    __slots__ = ('_environ', 'method', 'path', 'query_string', 'content_type',
+                 'content_length', 'server_name', 'server_port', 'server_protocol',
+                 'remote_address', 'remote_host',
+                 'max_body_size', '_consumed', '_scheme', '_full_path', '_params', '_form',
+                 '_files', '_input', '_data', '_body', '_headers', '_json', '_state')
+
+    def __init__(self, env, max_body_size=None):
         self._environ = env
-        self.scheme = wsgiref.util.guess_scheme(env)
+        self.max_body_size = max_body_size
+        self._consumed = False
         self.method = env.get('REQUEST_METHOD', None)
         self.path = env.get('PATH_INFO', None)
-        self._full_path = wsgiref.util.request_uri(env, include_query=False)
         self.query_string = env.get('QUERY_STRING', None)
         self.content_type = env.get('CONTENT_TYPE', None)
         self.content_length = env.get('CONTENT_LENGTH', None)
@@ -86,76 +206,205 @@ class Request(object):
         self.server_protocol = env.get('SERVER_PROTOCOL', None)
         self.remote_address = env.get('REMOTE_ADDR', None)
         self.remote_host = env.get('REMOTE_HOST', None)
-        self.params = parse_qs(self.query_string)
-        self.form = {}
-        self.files = {}
-        self.body = ''
-        if self.method not in HTTP_SAFE_METHODS:
-            self.form, self.files = self._parse_multipart()
-            self.body = self._get_body()
-        self.headers = Headers(
-            list({key: value for key, value in env.items() if key.startswith('HTTP')}.items()))
 
     def __str__(self):
         return '%s - %s' % (self.method, self.get_full_path())
 
     __repr__ = __str__
 
-    def _get_body(self):
-        fp = self._environ['wsgi.input']
-        if not fp:
-            return ''
-        fp.seek(0)
-        body = fp.read()
-        fp.seek(0)
-        return body.decode()
-
-    def _parse_multipart(self):
-        form = {}
-        files = {}
-        if self.content_type == 'application/json':
-            return form, files
-        fs = cgi.FieldStorage(fp=self._environ['wsgi.input'],
-                              environ=self._environ)
-        for field in fs.list:
-            if field.filename:
-                xfile = XFormFile(field.filename, field.value, field.type,
-                                  getattr(field, 'encoding', 'utf-8'))
-                files.setdefault(field.name, xfile)
-            else:
-                form.setdefault(field.name, field.value)
-        return form, files
+    @property
+    def environ(self):
+        return self._environ
+
+    @lazy_property
+    def scheme(self):
+        return wsgiref.util.guess_scheme(self._environ)
+
+    @lazy_property
+    def full_path(self):
+        return wsgiref.util.request_uri(self._environ, include_query=False)
+
+    @lazy_property
+    def params(self):
+        return parse_qs(self.query_string)
+
+    @lazy_property
+    def state(self):
+        """A dict for hooks and views to share request data"""
+        return {}
+
+    @lazy_property
+    def headers(self):
+        return Headers([(key, value) for key, value in self._environ.items() if key.startswith('HTTP')])
+
+    @lazy_property
+    def form(self):
+        form, self._files = self.parse_form()
+        return form
+
+    @lazy_property
+    def files(self):
+        self.form
+        return self._files
+
+    @lazy_property
+    def input(self):
+        """wsgi.input limited to the request content length"""
+        length = self.get_content_length()
+        if length is None and not self._environ.get('wsgi.input_terminated'):
+            # reading past the content length of a wsgi.input may block
+            length = 0
+        return LimitedStream(self._environ['wsgi.input'], length, self.max_body_size)
+
+    def _get_body_file(self):
+        if hasattr(self, '_data'):
+            return io.BytesIO(self._data)
+        if self._consumed:
+            raise SpeweException('request body already consumed')
+        self._consumed = True
+        return self.input
 
     @property
+    def stream(self):
+        """Iterate over the request body in chunks, without keeping it"""
+        return iter_stream(self._get_body_file())
+
+    @lazy_property
+    def data(self):
+        """The request body as bytes, read once"""
+        return b''.join(self.stream)
+
+    @lazy_property
+    def body(self):
+        _, options = parse_options_header(self.content_type)
+        return self.data.decode(options.get('charset', 'utf-8'))
+
+    def get_content_length(self):
+        try:
+            return int(self.content_length)
+        except (TypeError, ValueError):
+            return None
+
+    def parse_form(self, **callbacks):
+        """Parse the form data and the uploaded files.
+
+        Call it before accessing `form` or `files` to pass streaming
+        callbacks to the MultipartParser. A multipart body is streamed,
+        so it can't be read again afterwards.
+        """
+        form, files = {}, {}
+        if self.method not in HTTP_SAFE_METHODS:
+            content_type, options = parse_options_header(self.content_type)
+            charset = options.get('charset', 'utf-8')
+            if content_type == 'multipart/form-data':
+                parser = MultipartParser(self._get_body_file(), options.get('boundary'),
+                                         charset=charset, **callbacks)
+                form, files = parser.parse()
+            elif content_type == 'application/x-www-form-urlencoded':
+                # small enough to be kept, `data` and `body` remain readable
+                form, files = parse_urlencoded(io.BytesIO(self.data), charset=charset)
+        self._form, self._files = form, files
+        return form, files
+
+    @lazy_property
     def json(self):
-        if self.content_type == 'application/json':
-            return json.loads(self.body)
+        """The decoded json body, None for other content types"""
+        content_type, _ = parse_options_header(self.content_type)
+        if content_type == 'application/json':
+            return serializers.loads(self.data)
 
     def get_full_path(self):
-        return self._full_path
+        return self.full_path
 
     def build_absolute_uri(self, location):
-        return urljoin(self._full_path, location)
+        return urljoin(self.full_path, location)
+
+
+class ClosingIterator(object):
+    """Encode the chunks of an iterable, and close it along with the
+    response
+    """
+
+    def __init__(self, iterable, charset='utf-8', close=None):
+        self.iterable = iterable
+        self.charset = charset
+        self._close = close or getattr(iterable, 'close', None)
+
+    def __iter__(self):
+        charset = self.charset
+        for chunk in self.iterable:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode(charset)
+            if chunk:
+                yield chunk
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
 
 
 class BaseResponse(object):
 
     content_type = None
     status_code = 200
+    charset = 'utf-8'
 
     def __init__(self, data='', status_code=None, content_type=None, **kwargs):
         self.data = data
-        self.headers = Headers([])
         self.cookies = SimpleCookie()
         if status_code:
             self.status_code = status_code
+        # plain list of (name, value) tuples, handed as is to start_response
         if content_type:
             self.content_type = content_type
-        if self.content_type:
-            self.headers.add_header('Content-Type', self.content_type)
+            self.headerlist = [('Content-Type', content_type)]
+        else:
+            self.headerlist = list(self.get_default_headers())
+        self._headers = None
+
+    @classmethod
+    def get_default_headers(cls):
+        """The headers a response of the class starts with, built once"""
+        headers = cls.__dict__.get('_default_headers')
+        if headers is None:
+            headers = (('Content-Type', cls.content_type),) if cls.content_type else ()
+            cls._default_headers = headers
+        return headers
+
+    @property
+    def headers(self):
+        """A wsgiref Headers view over headerlist"""
+        if self._headers is None:
+            self._headers = Headers(self.headerlist)
+        return self._headers
+
+    def get_header(self, name, default=None):
+        name = name.lower()
+        for key, value in self.headerlist:
+            if key.lower() == name:
+                return value
+        return default
+
+    @property
+    def content(self):
+        """The response data as bytes"""
+        if isinstance(self.data, bytes):
+            return self.data
+        return self.data.encode(self.charset)
+
+    def get_body(self, environ=None):
+        """Return the wsgi iterable of the response"""
+        return [self.content]
+
+    def close(self):
+        pass
 
     def add_header(self, name, value, **kwargs):
-        self.headers.add_header(name, value, **kwargs)
+        if kwargs:
+            self.headers.add_header(name, value, **kwargs)
+        else:
+            self.headerlist.append((name, value))
 
     def set_cookie(self, name, value, path='/', expire=None, httponly=None):
         pass
@@ -174,10 +423,88 @@ class JsonResponse(BaseResponse):
     content_type = 'application/json'
 
     def __init__(self, data, status_code=200, **kwargs):
-        data = json.dumps(data)
+        data = serializers.dumps(data)
         super(JsonResponse, self).__init__(data, status_code=status_code, **kwargs)
 
 
+class StreamingResponse(BaseResponse):
+    """Response sent as its iterable (str or bytes chunks) is consumed"""
+
+    content_type = 'text/html; charset=UTF8'
+
+    def __init__(self, iterable, status_code=None, content_type=None, **kwargs):
+        super(StreamingResponse, self).__init__(iterable, status_code=status_code,
+                                                content_type=content_type, **kwargs)
+
+    @property
+    def content(self):
+        return b''.join(ClosingIterator(self.data, self.charset))
+
+    def get_body(self, environ=None):
+        return ClosingIterator(self.data, self.charset)
+
+    def close(self):
+        close = getattr(self.data, 'close', None)
+        if close is not None:
+            close()
+
+
+class JsonStreamResponse(StreamingResponse):
+    """Serialize the items of an iterable as they are consumed, into a
+    json array or, with ndjson, one json document per line
+    """
+
+    content_type = 'application/json'
+
+    def __init__(self, iterable, status_code=None, ndjson=False, **kwargs):
+        if ndjson:
+            kwargs.setdefault('content_type', 'application/x-ndjson')
+        super(JsonStreamResponse, self).__init__(serializers.iter_json(iterable, ndjson=ndjson),
+                                                 status_code=status_code, **kwargs)
+        self.iterable = iterable
+
+    def get_body(self, environ=None):
+        return ClosingIterator(self.data, self.charset, close=self.close)
+
+    def close(self):
+        super(JsonStreamResponse, self).close()
+        close = getattr(self.iterable, 'close', None)
+        if close is not None:
+            close()
+
+
+class FileResponse(StreamingResponse):
+    """Send a file, through wsgi.file_wrapper when the server has one"""
+
+    chunk_size = CHUNK_SIZE
+
+    def __init__(self, file, status_code=None, content_type=None, filename=None,
+                 as_attachment=False, **kwargs):
+        if not hasattr(file, 'read'):
+            filename = filename or os.path.basename(file)
+            file = open(file, 'rb')
+        if not content_type:
+            guessed, encoding = mimetypes.guess_type(filename or getattr(file, 'name', ''))
+            content_type = guessed or 'application/octet-stream'
+            if guessed and guessed.startswith('text/'):
+                content_type += '; charset=UTF8'
+        super(FileResponse, self).__init__(file, status_code=status_code,
+                                           content_type=content_type, **kwargs)
+        try:
+            self.add_header('Content-Length', str(os.fstat(file.fileno()).st_size - file.tell()))
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            pass
+        if as_attachment:
+            self.add_header('Content-Disposition', 'attachment', filename=filename)
+
+    def get_body(self, environ=None):
+        file_wrapper = (environ or {}).get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return file_wrapper(self.data, self.chunk_size)
+        chunks = iter(lambda: self.data.read(self.chunk_size), b'')
+        return ClosingIterator(chunks, close=self.data.close)
+
+
 class TemplateResponse(BaseResponse):
 
     def __init__(self, context):
@@ -190,6 +517,17 @@ class ResponseNoContent(BaseResponse):
     content_type = None
 
 
+class ResponseNotModified(BaseResponse):
+
+    status_code = 304
+    content_type = None
+
+    def __init__(self, headers=None):
+        super(ResponseNotModified, self).__init__(b'')
+        kept = set(name.lower() for name in NOT_MODIFIED_HEADERS)
+        self.headerlist.extend(header for header in headers or [] if header[0].lower() in kept)
+
+
 class ResponseRedirect(Response):
 
     status_code = 302
@@ -0,0 +1,291 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import re
+import shutil
+import tempfile
+
+try:
+    from urllib.parse import parse_qsl
+except (ImportError,):
+    from urlparse import parse_qsl
+
+from spewe.exceptions import BadRequest
+
+
+CHUNK_SIZE = 64 * 1024
+# parts bigger than this are written to a temporary file
+SPOOL_SIZE = 1024 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+MAX_FIELD_SIZE = 1024 * 1024
+
+OPTION_REGEX = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:\\.|[^"\\])*"|[^;]*)')
+
+
+def parse_options_header(value):
+    """Split a header like `multipart/form-data; boundary="xyz"`
+    into its main value and a dict of options
+    """
+    value = value or ''
+    main, _, rest = value.partition(';')
+    options = {}
+    for key, option in OPTION_REGEX.findall(';' + rest):
+        option = option.strip()
+        if len(option) > 1 and option[0] == option[-1] == '"':
+            option = option[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+        options[key.lower()] = option
+    return main.strip().lower(), options
+
+
+def iter_stream(stream, content_length=None, chunk_size=CHUNK_SIZE):
+    """Read a stream in chunks, stopping after content_length bytes if set"""
+    remaining = content_length
+    while remaining is None or remaining > 0:
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+
+class XFormFile(object):
+    """An uploaded file. Its content is kept in memory up to `spool_size`
+    bytes, and in a temporary file past that.
+    """
+
+    def __init__(self, filename, content=None, content_type=None, encoding=None,
+                 name=None, spool_size=SPOOL_SIZE):
+        self.filename = filename
+        self.content_type = content_type
+        self.encoding = encoding
+        self.name = name
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        if content:
+            self.write(content)
+            self.seek(0)
+
+    def __repr__(self):
+        return '<XFormFile: %s>' % self.filename
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        self.file.write(chunk)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def readline(self, size=-1):
+        return self.file.readline(size)
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def __iter__(self):
+        self.seek(0)
+        return iter(lambda: self.read(CHUNK_SIZE), b'')
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def data(self):
+        """The whole content as bytes"""
+        position = self.tell()
+        self.seek(0)
+        data = self.read()
+        self.seek(position)
+        return data
+
+    @property
+    def content(self):
+        """The whole content decoded as text"""
+        return self.data.decode(self.encoding or 'utf-8', 'replace')
+
+    def save(self, path):
+        position = self.tell()
+        self.seek(0)
+        with open(path, 'wb') as fp:
+            shutil.copyfileobj(self.file, fp, CHUNK_SIZE)
+        self.seek(position)
+
+
+class MultipartParser(object):
+    """Incremental multipart/form-data parser.
+
+    The input is read in `chunk_size` chunks and never buffered whole:
+    fields are kept in memory (up to `max_field_size` bytes) and files are
+    spooled into XFormFile objects. File content can be streamed elsewhere
+    by passing callbacks: `on_file_begin(xfile)`, `on_file_data(xfile, chunk)`
+    and `on_file_end(xfile)`. When `on_file_data` is set, the chunks are
+    handed to it instead of being stored in the XFormFile.
+    """
+
+    def __init__(self, stream, boundary, content_length=None, charset='utf-8',
+                 chunk_size=CHUNK_SIZE, spool_size=SPOOL_SIZE, max_field_size=MAX_FIELD_SIZE,
+                 on_file_begin=None, on_file_data=None, on_file_end=None):
+        if not boundary:
+            raise BadRequest('missing multipart boundary')
+        self.stream = stream
+        self.boundary = boundary.encode('latin-1') if not isinstance(boundary, bytes) else boundary
+        self.content_length = content_length
+        self.charset = charset
+        self.chunk_size = chunk_size
+        self.spool_size = spool_size
+        self.max_field_size = max_field_size
+        self.on_file_begin = on_file_begin
+        self.on_file_data = on_file_data
+        self.on_file_end = on_file_end
+
+    def _parse_headers(self, raw):
+        headers = {}
+        for line in raw.decode(self.charset, 'replace').split('\r\n'):
+            key, sep, value = line.partition(':')
+            if not sep:
+                raise BadRequest('invalid multipart header: %s' % line)
+            headers[key.strip().lower()] = value.strip()
+        return headers
+
+    def _begin_part(self, headers):
+        _, disposition = parse_options_header(headers.get('content-disposition'))
+        name = disposition.get('name')
+        filename = disposition.get('filename')
+        if not filename:
+            return [name, bytearray()]
+        xfile = XFormFile(filename, content_type=headers.get('content-type'),
+                          encoding=self.charset, name=name, spool_size=self.spool_size)
+        if self.on_file_begin:
+            self.on_file_begin(xfile)
+        return xfile
+
+    def _part_data(self, part, data):
+        if not data:
+            return
+        if isinstance(part, XFormFile):
+            if self.on_file_data:
+                part.size += len(data)
+                self.on_file_data(part, data)
+            else:
+                part.write(data)
+            return
+        part[1].extend(data)
+        if len(part[1]) > self.max_field_size:
+            raise BadRequest('form field %s is too large' % part[0])
+
+    def _end_part(self, part, form, files):
+        if isinstance(part, XFormFile):
+            part.seek(0)
+            if self.on_file_end:
+                self.on_file_end(part)
+            files.setdefault(part.name, part)
+        else:
+            form.setdefault(part[0], part[1].decode(self.charset, 'replace'))
+
+    def parse(self):
+        """Consume the stream and return a (form, files) tuple"""
+        form, files = {}, {}
+        opening = b'--' + self.boundary
+        delimiter = b'\r\n--' + self.boundary
+        buffer = b''
+        state = 'preamble'
+        part = None
+        chunks = iter_stream(self.stream, self.content_length, self.chunk_size)
+        eof = False
+        while state != 'done':
+            if state == 'preamble':
+                index = buffer.find(opening)
+                if index >= 0:
+                    buffer = buffer[index + len(opening):]
+                    state = 'boundary'
+                    continue
+                buffer = buffer[-len(opening):]
+            elif state == 'boundary':
+                # what follows a delimiter: CRLF for a new part, -- at the end
+                if len(buffer) >= 2:
+                    if buffer.startswith(b'--'):
+                        state = 'done'
+                        continue
+                    index = buffer.find(b'\r\n')
+                    if index >= 0:
+                        buffer = buffer[index + 2:]
+                        state = 'headers'
+                        continue
+            elif state == 'headers':
+                index = buffer.find(b'\r\n\r\n')
+                if index >= 0:
+                    part = self._begin_part(self._parse_headers(buffer[:index]))
+                    buffer = buffer[index + 4:]
+                    state = 'body'
+                    continue
+                if len(buffer) > MAX_HEADER_SIZE:
+                    raise BadRequest('multipart headers are too large')
+            elif state == 'body':
+                index = buffer.find(delimiter)
+                if index >= 0:
+                    self._part_data(part, buffer[:index])
+                    self._end_part(part, form, files)
+                    buffer = buffer[index + len(delimiter):]
+                    state = 'boundary'
+                    continue
+                # keep what could be the beginning of a delimiter
+                keep = len(delimiter) - 1
+                if len(buffer) > keep:
+                    self._part_data(part, buffer[:-keep])
+                    buffer = buffer[-keep:]
+            if eof:
+                raise BadRequest('unexpected end of multipart data')
+            try:
+                buffer += next(chunks)
+            except (StopIteration,):
+                eof = True
+        return form, files
+
+
+def parse_urlencoded(stream, content_length=None, charset='utf-8',
+                     chunk_size=CHUNK_SIZE, max_field_size=MAX_FIELD_SIZE):
+    """Parse an application/x-www-form-urlencoded body chunk by chunk"""
+    form = {}
+    pending = b''
+
+    def add_pairs(data):
+        try:
+            # percent-decode to bytes, whatever the charset is
+            pairs = [(key.encode('latin-1'), value.encode('latin-1')) for key, value in
+                     parse_qsl(data.decode('latin-1'), keep_blank_values=True, encoding='latin-1')]
+        except (TypeError,):
+            pairs = parse_qsl(data, keep_blank_values=True)
+        for key, value in pairs:
+            form.setdefault(key.decode(charset, 'replace'), value.decode(charset, 'replace'))
+
+    for chunk in iter_stream(stream, content_length, chunk_size):
+        pending += chunk
+        index = pending.rfind(b'&')
+        if index >= 0:
+            add_pairs(pending[:index])
+            pending = pending[index + 1:]
+        if len(pending) > max_field_size:
+            raise BadRequest('form field is too large')
+    if pending:
+        add_pairs(pending)
+    return form, {}
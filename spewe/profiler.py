@@ -0,0 +1,101 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from spewe.stats import timer
+
+
+class TemplateProfiler(object):
+    """Collects the timings of profiled template renderings.
+
+    Frames are the rendered templates, their nodes and evaluated
+    expressions, identified by (template name, line number, label). For
+    each one, the number of calls, the cumulative and self times and the
+    size of the output are kept, along with the self time of each stack
+    of frames.
+    """
+
+    def __init__(self):
+        self.frames = {}
+        self.stacks = {}
+        self._stack = []
+
+    def start(self):
+        # an exception may have left frames behind
+        del self._stack[:]
+
+    def enter(self, frame, out):
+        self._stack.append([frame, timer(), 0.0, out, len(out)])
+
+    def exit(self):
+        now = timer()
+        stack = self._stack
+        frame, start, children, out, size = stack.pop()
+        elapsed = now - start
+        if stack:
+            stack[-1][2] += elapsed
+        stats = self.frames.get(frame)
+        if stats is None:
+            stats = self.frames[frame] = [0, 0.0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += elapsed - children
+        stats[3] += sum(len(chunk.encode('utf-8')) for chunk in out[size:])
+        path = tuple(entry[0] for entry in stack) + (frame,)
+        self.stacks[path] = self.stacks.get(path, 0.0) + elapsed - children
+
+    def clear(self):
+        self.frames.clear()
+        self.stacks.clear()
+        self.start()
+
+    def stats(self, sort='total'):
+        """[(frame, calls, total, self, size)] sorted by decreasing
+        `sort`: calls, total, self or size
+        """
+        index = ('calls', 'total', 'self', 'size').index(sort) + 1
+        rows = [(frame,) + tuple(stats) for frame, stats in self.frames.items()]
+        rows.sort(key=lambda row: row[index], reverse=True)
+        return rows
+
+    def report(self, sort='total', limit=None):
+        """The frames stats as a text table"""
+        lines = ['%8s %10s %10s %10s  %s' % ('calls', 'total ms', 'self ms', 'bytes', 'frame')]
+        for frame, calls, total, self_time, size in self.stats(sort)[:limit]:
+            lines.append('%8d %10.3f %10.3f %10d  %s' % (calls, total * 1000, self_time * 1000, size,
+                                                          format_frame(frame)))
+        return '\n'.join(lines)
+
+    def collapsed(self):
+        """Self times as collapsed stacks, in microseconds, as taken by
+        flamegraph.pl or speedscope
+        """
+        lines = []
+        for path, self_time in sorted(self.stacks.items()):
+            stack = ';'.join(format_frame(frame).replace(';', ',') for frame in path)
+            lines.append('%s %d' % (stack, round(self_time * 1e6)))
+        return '\n'.join(lines) + '\n'
+
+    def dump_collapsed(self, path):
+        with open(path, 'w') as fp:
+            fp.write(self.collapsed())
+
+
+def format_frame(frame):
+    name, lineno, label = frame
+    return '%s:%d %s' % (name, lineno, label) if lineno else name
@@ -0,0 +1,113 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import re
+from collections import namedtuple
+
+
+LITERAL_URL = re.compile(r'^\^?([\w/.~-]*)$')
+GROUP_NAME = re.compile(r'\(\?P([<=])(\w+)')
+# patterns which can't be safely embedded into a bigger alternation
+UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?\(|^\(\?[aiLmsux]+\)')
+
+
+RouteMatch = namedtuple('RouteMatch', ['route', 'params', 'methods'])
+
+
+class Router(object):
+    """Resolves a path to a route.
+
+    Routes are tried in registration order with `re.match` semantics,
+    but the lookup tables are only built once: literal urls go into a
+    dict and the other patterns are merged into a few alternation regexes
+    with one group per route.
+    """
+
+    def __init__(self):
+        self.routes = []
+        self._table = None
+
+    def add(self, route):
+        self.routes.append(route)
+        self._table = None
+
+    def _scan(self, path):
+        for route in self.routes:
+            match = re.match(route.url, path)
+            if match:
+                return route, match.groupdict()
+        return None, None
+
+    def _combine(self, indexes):
+        parts = []
+        groups = {}
+        for index in indexes:
+            route = self.routes[index]
+            prefix = '_r%d_' % index
+            names = {}
+
+            def rename(match):
+                names[prefix + match.group(2)] = match.group(2)
+                return '(?P%s%s%s' % (match.group(1), prefix, match.group(2))
+
+            pattern = GROUP_NAME.sub(rename, route.url)
+            parts.append('(?P<_r%d>%s)' % (index, pattern))
+            groups['_r%d' % index] = (route, names, frozenset(route.methods))
+        return re.compile('|'.join(parts)), groups
+
+    def build(self):
+        literals = {}
+        segments = []
+        pending = []
+        for index, route in enumerate(self.routes):
+            literal = LITERAL_URL.match(route.url)
+            if literal and literal.group(1) not in literals:
+                path = literal.group(1)
+                # an earlier route may shadow this exact path
+                match_route, params = self._scan(path)
+                literals[path] = RouteMatch(match_route, params, frozenset(match_route.methods))
+            if UNCOMBINABLE.search(route.url):
+                if pending:
+                    segments.append(self._combine(pending))
+                    pending = []
+                segments.append((re.compile(route.url), route))
+            else:
+                pending.append(index)
+        if pending:
+            segments.append(self._combine(pending))
+        self._table = literals, segments
+        return self._table
+
+    def match(self, path):
+        """Return a RouteMatch for path or None"""
+        literals, segments = self._table or self.build()
+        found = literals.get(path)
+        if found is not None:
+            return found
+        # groups is either a route or a dict mapping group names to routes
+        for regex, groups in segments:
+            match = regex.match(path)
+            if not match:
+                continue
+            if isinstance(groups, dict):
+                route, names, methods = groups[match.lastgroup]
+                params = {name: match.group(group) for group, name in names.items()}
+                return RouteMatch(route, params, methods)
+            return RouteMatch(groups, match.groupdict(), frozenset(groups.methods))
+        return None
@@ -0,0 +1,121 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import json
+
+
+class JsonBackend(object):
+    """The standard library json module"""
+
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def loads(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class OrjsonBackend(object):
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.dumps = orjson.dumps
+        self.loads = orjson.loads
+
+
+class UjsonBackend(JsonBackend):
+
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.module = ujson
+
+    def dumps(self, obj):
+        return self.module.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    def loads(self, data):
+        return self.module.loads(data)
+
+
+# fastest first, for the 'auto' backend
+BACKENDS = (OrjsonBackend, UjsonBackend, JsonBackend)
+
+
+def get_backend(name='auto'):
+    """Return the json backend `name`, or the fastest one installed for
+    'auto'
+    """
+    for backend_class in BACKENDS:
+        if name in ('auto', backend_class.name):
+            try:
+                return backend_class()
+            except (ImportError,):
+                if name != 'auto':
+                    raise
+    raise ValueError('unknown json backend %s' % name)
+
+
+backend = JsonBackend()
+
+
+def set_backend(name):
+    """Use the json backend `name` for requests and responses"""
+    global backend
+    backend = get_backend(name)
+    return backend
+
+
+def dumps(obj):
+    """Serialize obj to json bytes"""
+    return backend.dumps(obj)
+
+
+def loads(data):
+    return backend.loads(data)
+
+
+def iter_json(iterable, ndjson=False, chunk_size=64 * 1024):
+    """Serialize the items of iterable as a json array, or one per line
+    with ndjson, yielding chunks of about chunk_size bytes
+    """
+    encode = backend.dumps
+    buffer, size, first = [] if ndjson else [b'['], 0, True
+    for item in iterable:
+        data = encode(item)
+        if ndjson:
+            buffer.extend((data, b'\n'))
+        else:
+            if not first:
+                buffer.append(b',')
+            buffer.append(data)
+        first = False
+        size += len(data) + 1
+        if size >= chunk_size:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if not ndjson:
+        buffer.append(b']')
+    if buffer:
+        yield b''.join(buffer)
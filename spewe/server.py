@@ -0,0 +1,208 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import signal
+import socket
+import threading
+
+try:
+    from queue import Queue
+except (ImportError,):
+    from Queue import Queue
+
+
+class ThreadPoolMixIn(object):
+    """Handle requests in a fixed pool of worker threads.
+
+    Accepted connections are queued for the workers; once `pool_size`
+    connections are waiting, the accepting thread blocks and new clients
+    pile up in the listen backlog (`request_queue_size`).
+    """
+
+    pool_size = 8
+    daemon_threads = True
+
+    def _start_workers(self):
+        self._requests = Queue(maxsize=self.pool_size)
+        self._workers = []
+        for _ in range(self.pool_size):
+            worker = threading.Thread(target=self._process_requests)
+            worker.daemon = self.daemon_threads
+            worker.start()
+            self._workers.append(worker)
+
+    def _process_requests(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except (Exception,):
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if getattr(self, '_workers', None) is None:
+            self._start_workers()
+        self._requests.put((request, client_address))
+
+    def server_close(self):
+        super(ThreadPoolMixIn, self).server_close()
+        for _ in getattr(self, '_workers', None) or []:
+            self._requests.put(None)
+        for worker in getattr(self, '_workers', None) or []:
+            worker.join()
+        self._workers = None
+
+
+def make_server_class(server_class, threads=None, backlog=None):
+    """Return server_class tuned for the given pool size and backlog"""
+    attrs = {}
+    bases = (server_class,)
+    if threads:
+        attrs['pool_size'] = threads
+        bases = (ThreadPoolMixIn, server_class)
+    if backlog:
+        attrs['request_queue_size'] = backlog
+    if not attrs:
+        return server_class
+    return type(server_class.__name__, bases, attrs)
+
+
+class PreforkServer(object):
+    """Pre-fork server: the master binds the socket, then forks `workers`
+    processes accepting on the shared listener. Workers exiting (crash or
+    `max_requests` reached) are replaced.
+    """
+
+    def __init__(self, app, server_name='localhost', port=8099, server_class=None,
+                 handler_class=None, workers=2, max_requests=None, reuse_port=False):
+        self.app = app
+        self.address = (server_name, port)
+        self.server_class = server_class
+        self.handler_class = handler_class
+        self.workers = workers
+        self.max_requests = max_requests
+        self.reuse_port = reuse_port
+        self.httpd = None
+        self.pids = set()
+        self.alive = True
+        self.pid = None
+
+    @property
+    def server_port(self):
+        return self.httpd.server_port
+
+    def bind(self):
+        if self.httpd is not None:
+            return self.httpd
+        httpd = self.server_class(self.address, self.handler_class, bind_and_activate=False)
+        if self.reuse_port:
+            httpd.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            httpd.server_bind()
+            httpd.server_activate()
+        except (Exception,):
+            httpd.server_close()
+            raise
+        httpd.set_app(self.app)
+        self.httpd = httpd
+        return httpd
+
+    def _block_signals(self, block):
+        # python 2 has no pthread_sigmask, the window stays open there
+        if hasattr(signal, 'pthread_sigmask'):
+            how = signal.SIG_BLOCK if block else signal.SIG_UNBLOCK
+            signal.pthread_sigmask(how, [signal.SIGTERM])
+
+    def spawn(self):
+        # hold SIGTERM back until the master knows the pid and the worker
+        # has restored the default handler, otherwise a worker could leak
+        self._block_signals(True)
+        try:
+            pid = os.fork()
+        except (OSError,):
+            self._block_signals(False)
+            raise
+        if pid:
+            self.pids.add(pid)
+            self._block_signals(False)
+            return pid
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self._block_signals(False)
+            self.serve_worker()
+        except (Exception,):
+            status = 1
+        finally:
+            os._exit(status)
+
+    def serve_worker(self):
+        served = 0
+        while self.max_requests is None or served < self.max_requests:
+            self.httpd.handle_request()
+            served += 1
+        self.httpd.server_close()
+
+    def _stop(self, signum, frame):
+        if os.getpid() != self.pid:
+            # a worker signaled before restoring the default handler
+            os._exit(0)
+        self.alive = False
+        raise KeyboardInterrupt()
+
+    def stop(self):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except (OSError,):
+                pass
+        for pid in list(self.pids):
+            try:
+                os.waitpid(pid, 0)
+            except (OSError,):
+                pass
+        self.pids.clear()
+        self.httpd.server_close()
+
+    def serve_forever(self):
+        self.bind()
+        if hasattr(self.app, 'warmup'):
+            self.app.warmup()
+        self.pid = os.getpid()
+        signal.signal(signal.SIGTERM, self._stop)
+        try:
+            for _ in range(self.workers):
+                self.spawn()
+            while self.alive:
+                pid, _ = os.wait()
+                if pid in self.pids:
+                    self.pids.discard(pid)
+                    if self.alive:
+                        self.spawn()
+        except (KeyboardInterrupt,):
+            pass
+        finally:
+            self.stop()
@@ -0,0 +1,139 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import mimetypes
+import os
+import threading
+import time
+
+from spewe.http import (FileResponse, Response, ResponseNotModified, http_date, is_not_modified,
+                        parse_accept_encoding, status)
+
+
+# pre-compressed siblings, by order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+class StaticFile(object):
+
+    __slots__ = ('path', 'size', 'mtime', 'etag', 'last_modified', 'content_type',
+                 'variants', 'checked_at')
+
+    def __init__(self, path, stat):
+        self.path = path
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.etag = '"%x-%x"' % (int(stat.st_mtime * 1000000), stat.st_size)
+        self.last_modified = http_date(stat.st_mtime)
+        content_type, _ = mimetypes.guess_type(path)
+        content_type = content_type or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type == 'application/javascript':
+            content_type += '; charset=UTF8'
+        self.content_type = content_type
+        self.variants = []
+        for encoding, extension in ENCODINGS:
+            try:
+                variant = os.stat(path + extension)
+            except (OSError,):
+                continue
+            etag = '"%x-%x-%s"' % (int(variant.st_mtime * 1000000), variant.st_size, encoding)
+            self.variants.append((encoding, path + extension, variant.st_size, etag))
+        self.checked_at = time.time()
+
+
+class StaticFiles(object):
+    """Serve the files of `directory` under `url`.
+
+    Files metadata (stat, ETag, content type, pre-compressed `.gz`/`.br`
+    siblings) are kept in a table. When `check_interval` is set, they are
+    refreshed at most every `check_interval` seconds, otherwise never.
+    """
+
+    def __init__(self, directory, url='/static/', max_age=3600, check_interval=None):
+        self.directory = os.path.abspath(directory)
+        self.url = url
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def match(self, path):
+        return path.startswith(self.url)
+
+    def get_path(self, path):
+        name = path[len(self.url):].lstrip('/')
+        fullpath = os.path.normpath(os.path.join(self.directory, name))
+        if not fullpath.startswith(self.directory + os.sep):
+            return None
+        return fullpath
+
+    def get_file(self, path):
+        fullpath = self.get_path(path)
+        if fullpath is None:
+            return None
+        static_file = self._files.get(fullpath)
+        if static_file is not None:
+            if self.check_interval is None or time.time() - static_file.checked_at < self.check_interval:
+                return static_file
+        try:
+            stat = os.stat(fullpath)
+        except (OSError,):
+            return None
+        if not os.path.isfile(fullpath):
+            return None
+        static_file = StaticFile(fullpath, stat)
+        with self._lock:
+            self._files[fullpath] = static_file
+        return static_file
+
+    def __call__(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            response = Response(data='Method not allowed', status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+            response.add_header('Allow', 'GET, HEAD')
+            return response
+        static_file = self.get_file(request.path)
+        if static_file is None:
+            return Response(data='Page not found', status_code=status.HTTP_404_NOT_FOUND)
+
+        path, size, etag, encoding = static_file.path, static_file.size, static_file.etag, None
+        if static_file.variants:
+            accepted = parse_accept_encoding(request.headers.get('HTTP_ACCEPT_ENCODING'))
+            for variant_encoding, variant_path, variant_size, variant_etag in static_file.variants:
+                if variant_encoding in accepted:
+                    encoding, path, size, etag = variant_encoding, variant_path, variant_size, variant_etag
+                    break
+
+        if is_not_modified(request, etag, static_file.mtime):
+            response = ResponseNotModified()
+        elif request.method == 'HEAD':
+            response = Response(b'', content_type=static_file.content_type)
+            response.add_header('Content-Length', str(size))
+        else:
+            try:
+                response = FileResponse(path, content_type=static_file.content_type)
+            except (IOError, OSError):
+                return Response(data='Page not found', status_code=status.HTTP_404_NOT_FOUND)
+        response.add_header('ETag', etag)
+        response.add_header('Last-Modified', static_file.last_modified)
+        response.add_header('Cache-Control', 'public, max-age=%d' % self.max_age)
+        if static_file.variants:
+            response.add_header('Vary', 'Accept-Encoding')
+        if encoding and response.status_code != 304:
+            response.add_header('Content-Encoding', encoding)
+        return response
@@ -0,0 +1,129 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import math
+import threading
+import time
+
+timer = getattr(time, 'perf_counter', time.time)
+
+UNMATCHED = '(unmatched)'
+
+
+class Timing(object):
+    """Durations of the consecutive phases of a request"""
+
+    __slots__ = ('start', 'last', 'phases', 'route')
+
+    def __init__(self):
+        self.start = self.last = timer()
+        self.phases = []
+        self.route = UNMATCHED
+
+    def mark(self, phase):
+        """End phase, which started at the previous mark"""
+        now = timer()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    @property
+    def total(self):
+        return self.last - self.start
+
+    def server_timing(self):
+        """Value of the Server-Timing header, durations in milliseconds"""
+        entries = ['%s;dur=%.3f' % (phase, duration * 1000) for phase, duration in self.phases]
+        entries.append('total;dur=%.3f' % (self.total * 1000))
+        return ', '.join(entries)
+
+
+class Histogram(object):
+    """Durations counted in logarithmic buckets, each one 5% wider than
+    the previous, from 1us
+    """
+
+    minimum = 1e-6
+    growth = math.log(1.05)
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        index = int(math.log(value / self.minimum) / self.growth) if value > self.minimum else 0
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def percentile(self, rank):
+        """Upper bound of the bucket holding the rank percentile"""
+        if not self.count:
+            return 0.0
+        threshold = rank / 100.0 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= threshold:
+                break
+        return min(self.minimum * math.exp(self.growth * (index + 1)), self.max)
+
+    def summary(self):
+        """count, mean, p50, p95, p99 and max, durations in milliseconds"""
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count * 1000 if self.count else 0.0,
+            'p50': self.percentile(50) * 1000,
+            'p95': self.percentile(95) * 1000,
+            'p99': self.percentile(99) * 1000,
+            'max': self.max * 1000,
+        }
+
+
+class Stats(object):
+    """Per route histograms of the request phases"""
+
+    def __init__(self):
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, timing):
+        durations = {'total': timing.total}
+        for phase, duration in timing.phases:
+            durations[phase] = durations.get(phase, 0) + duration
+        with self._lock:
+            phases = self.routes.setdefault(timing.route, {})
+            for phase, duration in durations.items():
+                histogram = phases.get(phase)
+                if histogram is None:
+                    histogram = phases[phase] = Histogram()
+                histogram.add(duration)
+
+    def summary(self):
+        """{route name: {phase: Histogram.summary()}}"""
+        with self._lock:
+            return dict((route, dict((phase, histogram.summary()) for phase, histogram in phases.items()))
+                        for route, phases in self.routes.items())
+
+    def reset(self):
+        with self._lock:
+            self.routes.clear()
@@ -0,0 +1,48 @@
+# Copyright (c) 2017 Josue Kouka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+class HttpStatus(object):
+
+    def __init__(self):
+        self._statuses = {}
+        try:
+            from http.server import HTTPStatus
+            self._statuses = {status.value: status.phrase for status in HTTPStatus}
+        except (ImportError,):
+            import httplib
+            self._statuses = httplib.responses
+        # full status lines, as given to start_response
+        self._lines = {}
+        for value, phrase in self._statuses.items():
+            self._lines[value] = '%d %s' % (value, phrase.upper())
+            phrase = 'HTTP_%d_%s' % (value, phrase.upper().replace(' ', '_'))
+            setattr(self, phrase, value)
+        # renamed "Content Too Large" by python 3.13
+        self.HTTP_413_REQUEST_ENTITY_TOO_LARGE = 413
+
+    def describe(self, status_code):
+        try:
+            return self._lines[status_code]
+        except (KeyError,):
+            return '%d UNKNOWN' % status_code
+
+
+status = HttpStatus()
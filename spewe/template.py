@@ -18,18 +18,30 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import ast
+import copy
+import hashlib
 import io
+import os
 import re
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict, namedtuple
 
+from spewe.cache import LRUCache
 from spewe.exceptions import (TemplateContextError, TemplateNotFound,
                               TemplateSyntaxError, TemplateAttributeError)
 
 
 VAR_TOKEN_START, VAR_TOKEN_END = "{{", "}}"
 BLOCK_TOKEN_START, BLOCK_TOKEN_END = "{%", "%}"
-TOKEN_REGEX = re.compile(r"(%s.*?%s|%s.*?%s)" % (
-    VAR_TOKEN_START, VAR_TOKEN_END, BLOCK_TOKEN_START, BLOCK_TOKEN_END))
-WHITESPACE = re.compile('\s+')
+# a tag may span several lines, a "-" against its delimiters strips the
+# whitespace before or after it
+TOKEN_REGEX = re.compile(r"(%s.*?%s|%s.*?%s)" % tuple(map(re.escape, (
+    VAR_TOKEN_START, VAR_TOKEN_END, BLOCK_TOKEN_START, BLOCK_TOKEN_END))), re.DOTALL)
+WHITESPACE = re.compile(r'\s+')
 
 TEXT = 0
 VAR = 1
@@ -37,6 +49,11 @@ BLOCK_START = 2
 BLOCK_END = 3
 DOT = '.'
 
+# default store of the {% cache %} fragments
+fragment_cache = LRUCache(8 * 1024 * 1024)
+# syntax trees of the expressions met by the templates
+expression_cache = LRUCache(max_entries=4096)
+
 
 def evaluate(name, context, if_scope=False):
     try:
@@ -58,31 +75,68 @@ def evaluate(name, context, if_scope=False):
     return result
 
 
-class LToken(object):
+# content is the tag without its delimiters, stripped, or the text
+LToken = namedtuple('LToken', 'content_type content raw_content lineno col')
 
-    def __init__(self, raw_content):
-        self.raw_content = raw_content
-        self.content = self.clean(raw_content)
-        if raw_content.startswith(VAR_TOKEN_START):
-            self.content_type = VAR
-        elif self.content.startswith('end'):
-            self.content_type = BLOCK_END
-        elif raw_content.startswith(BLOCK_TOKEN_START):
-            self.content_type = BLOCK_START
-        else:
-            self.content_type = TEXT
 
-    def __repr__(self):
-        return '<LToken:%s - %s>' % (self.content_type, self.content)
-
-    def clean(self, raw_content):
-        if raw_content.startswith((VAR_TOKEN_START, BLOCK_TOKEN_START)):
-            return raw_content[2:-2].strip()
-        return raw_content
+def tokenize(source):
+    """Split the template source into a list of LToken, in a single scan"""
+    tokens = []
+    append = tokens.append
+    new_token = tuple.__new__
+    parts = TOKEN_REGEX.split(source)
+    lineno = 1
+    col = 1
+    strip_next = False
+    # parts alternate text and tags, starting and ending with text
+    for text, tag in zip(parts[0::2], parts[1::2]):
+        strip_previous = tag[2] == '-'
+        if text:
+            raw_text = text
+            if strip_next:
+                text = text.lstrip()
+            if strip_previous:
+                text = text.rstrip()
+            if text:
+                append(new_token(LToken, (TEXT, text, raw_text, lineno, col)))
+            if '\n' in raw_text:
+                lineno += raw_text.count('\n')
+                col = len(raw_text) - raw_text.rindex('\n')
+            else:
+                col += len(raw_text)
+        strip_next = tag[-3] == '-'
+        content = tag[2 + strip_previous:-2 - strip_next].strip()
+        if '{' in content and (VAR_TOKEN_START in content or BLOCK_TOKEN_START in content):
+            # the tag swallowed the next one: it was never closed
+            end = min(index for index in (tag.find(VAR_TOKEN_START, 2), tag.find(BLOCK_TOKEN_START, 2))
+                      if index >= 0)
+            raise TemplateSyntaxError('<%s>: tag not closed' % tag[:end].rstrip()).locate(None, lineno, col)
+        if tag.startswith(VAR_TOKEN_START):
+            content_type = VAR
+        elif content.startswith('end'):
+            content_type = BLOCK_END
+        else:
+            content_type = BLOCK_START
+        append(new_token(LToken, (content_type, content, tag, lineno, col)))
+        if '\n' in tag:
+            lineno += tag.count('\n')
+            col = len(tag) - tag.rindex('\n')
+        else:
+            col += len(tag)
+    text = parts[-1]
+    if strip_next:
+        text = text.lstrip()
+    if text:
+        append(new_token(LToken, (TEXT, text, parts[-1], lineno, col)))
+    return tokens
 
 
 class Node(object):
 
+    # name of the file the node comes from, when it's not the template
+    # being compiled (see Template.resolve)
+    template = None
+
     def __init__(self, token=None):
         self.token = token
         self.children = []
@@ -91,7 +145,30 @@ class Node(object):
         return "<%s>" % self.__class__.__name__
 
     def render(self, context):
-        return ''.join([str(child.render(context)) for child in self.children])
+        return ''.join([child.render(context) for child in self.children])
+
+    def compile(self, writer):
+        for child in self.children:
+            writer.node(child)
+
+    def label(self):
+        return ' '.join(self.token.raw_content.split())
+
+    def syntax_error(self, message):
+        return TemplateSyntaxError(message).locate(None, self.token.lineno, self.token.col)
+
+    def expressions(self):
+        """The (expression, if_scope) evaluated by the node itself"""
+        return []
+
+    def optimize(self, children, in_loop):
+        """Copy of the node with the given optimized children, or the
+        node to use in its place, or None to drop it
+        """
+        clone = self.__class__.__new__(self.__class__)
+        clone.__dict__.update(self.__dict__)
+        clone.children = tuple(children)
+        return clone
 
 
 class ScopeNodeMixin(object):
@@ -110,34 +187,113 @@ class TextNode(Node):
     def render(self, context):
         return self.token.content
 
+    def label(self):
+        return 'text'
+
+    def compile(self, writer):
+        if self.token.content:
+            writer.write('_spewe_append(%r)' % (self.token.content,))
+
+    def optimize(self, children, in_loop):
+        if self.token.content:
+            return super(TextNode, self).optimize(children, in_loop)
+
 
 class VarNode(Node):
 
+    # the expression is known to give a string, no need to convert it
+    is_string = False
+
     def render(self, context):
-        content = self.token.content
-        return evaluate(content, context)
+        value = evaluate(self.token.content, context)
+        return value if self.is_string else str(value)
+
+    def compile(self, writer):
+        value = writer.expression(self.token.content)
+        if self.is_string:
+            writer.write('_spewe_append(%s)' % value)
+        else:
+            writer.write('_spewe_append(_spewe_str(%s))' % value)
+
+    def expressions(self):
+        return [(self.token.content, False)]
+
+    def optimize(self, children, in_loop):
+        try:
+            value = constant(self.token.content)
+        except (ValueError,):
+            clone = super(VarNode, self).optimize(children, in_loop)
+            clone.is_string = is_string(self.token.content)
+            return clone
+        return TextNode(self.token._replace(content_type=TEXT, content=str(value)))
 
 
 class LoopNode(Node, ScopeNodeMixin):
 
     endblock_tag = 'endloop'
+    # (expression, if_scope) of the body not depending on the loop item,
+    # evaluated at most once by the compiled template
+    invariants = ()
+
+    def __init__(self, token):
+        super(LoopNode, self).__init__(token)
+        self.iterable = token.content.split()[-1]
 
     def render(self, context):
-        content = self.token.content
-        iterable_name = content.strip().split()[-1]
-        iterable = evaluate(iterable_name, context)
+        iterable = evaluate(self.iterable, context)
         rendered = []
         for item in iterable:
             context['item'] = item
-            rendered.append(''.join([str(child.render(context)) for child in self.children]))
+            rendered.append(''.join([child.render(context) for child in self.children]))
         return ''.join(rendered)
 
+    def compile(self, writer):
+        iterable = writer.expression(self.iterable)
+        hoisted = writer.hoisted
+        if hoisted is None and self.invariants:
+            writer.hoisted = {}
+            for invariant in self.invariants:
+                name = writer.hoisted[invariant] = writer.new_name()
+                writer.write('%s = _spewe_unset' % name)
+        item = writer.new_name()
+        writer.write('for %s in %s:' % (item, iterable))
+        writer.indent()
+        writer.write("_spewe_context['item'] = %s" % item)
+        writer.dedent()
+        writer.block(self.children)
+        writer.hoisted = hoisted
+
+    def expressions(self):
+        return [(self.iterable, False)]
+
+    def optimize(self, children, in_loop):
+        clone = super(LoopNode, self).optimize(children, in_loop)
+        if not in_loop:
+            invariants = OrderedDict()
+            for node in walk(clone):
+                if isinstance(node, LoopNode):
+                    # an iterable may be consumed, it's evaluated each time
+                    continue
+                for expression in node.expressions():
+                    if 'item' not in get_names(expression[0]) and not has_calls(expression[0]):
+                        invariants[expression] = None
+            clone.invariants = tuple(invariants)
+        return clone
+
 
 class IfNode(Node, ScopeNodeMixin):
 
     endblock_tag = 'endif'
+    # (if_branch, else_branch) of an optimized node
+    branches = None
+
+    def __init__(self, token):
+        super(IfNode, self).__init__(token)
+        self.condition = ' '.join(token.content.split()[1:])
 
     def get_branches(self):
+        if self.branches is not None:
+            return self.branches
         if_branch = []
         else_branch = []
         cur_branch = if_branch  # default branch
@@ -148,8 +304,7 @@ class IfNode(Node, ScopeNodeMixin):
         return if_branch, else_branch
 
     def render(self, context):
-        content = ' '.join(self.token.content.split()[1:])
-        result = evaluate(content, context, if_scope=True)
+        result = evaluate(self.condition, context, if_scope=True)
         if_branch, else_branch = self.get_branches()
         if result:
             branch = if_branch
@@ -157,7 +312,153 @@ class IfNode(Node, ScopeNodeMixin):
             branch = else_branch
         else:
             return ''
-        return ''.join([str(child.render(context)) for child in branch])
+        return ''.join([child.render(context) for child in branch])
+
+    def compile(self, writer):
+        result = writer.expression(self.condition, if_scope=True)
+        if_branch, else_branch = self.get_branches()
+        writer.write('if %s:' % result)
+        writer.block(if_branch)
+        if else_branch:
+            writer.write('else:')
+            writer.block(else_branch)
+
+    def expressions(self):
+        return [(self.condition, True)]
+
+    def optimize(self, children, in_loop):
+        clone = super(IfNode, self).optimize(children, in_loop)
+        if_branch, else_branch = clone.get_branches()
+        try:
+            value = constant(self.condition)
+        except (ValueError,):
+            clone.branches = (tuple(if_branch), tuple(else_branch))
+            return clone
+        # only the branch taken is kept, in a plain node
+        node = Node()
+        if value:
+            node.children = if_branch
+        else:
+            # the else branch is the ElseNode and its children
+            node.children = [child for else_node in else_branch for child in else_node.children]
+        return node
+
+
+class CacheNode(Node, ScopeNodeMixin):
+    """{% cache name [expression ...] ttl %}: the rendered body is kept
+    ttl seconds, keyed on the template, the source of the block, its
+    name and the values of the expressions
+    """
+
+    endblock_tag = 'endcache'
+    # (name, expressions, ttl) of an optimized node
+    args = None
+
+    def parse(self):
+        if self.args is not None:
+            return self.args
+        args = self.token.content.split()[1:]
+        if len(args) < 2:
+            raise self.syntax_error(self.token.raw_content)
+        return args[0], args[1:-1], args[-1]
+
+    def digest(self):
+        """Digest of the source of the block, telling apart the blocks
+        of the templates sharing a name
+        """
+        source = [self.token.raw_content]
+        source.extend(node.token.raw_content for node in walk(self) if node.token is not None)
+        return hashlib.sha1(''.join(source).encode('utf-8')).hexdigest()[:16]
+
+    def render(self, context):
+        name, expressions, ttl = self.parse()
+        key = (self.template or '<template>', self.digest(), name) + tuple(
+            str(evaluate(expression, context)) for expression in expressions)
+        content = fragment_cache.get(key)
+        if content is None:
+            content = ''.join([child.render(context) for child in self.children])
+            fragment_cache.set(key, content, ttl=evaluate(ttl, context), size=len(content))
+        return content
+
+    def compile(self, writer):
+        name, expressions, ttl = self.parse()
+        values = [writer.expression(expression) for expression in expressions]
+        key = writer.new_name()
+        writer.write('%s = (%r, %r, %r,%s)' % (key, writer.name, self.digest(), name,
+                                               ''.join(' _spewe_str(%s),' % value for value in values)))
+        content = writer.new_name()
+        writer.write('%s = _spewe_cache.get(%s)' % (content, key))
+        writer.write('if %s is None:' % content)
+        writer.indent()
+        # render the body in a buffer of its own
+        out = writer.new_name()
+        writer.write('%s = _spewe_out' % out)
+        writer.write('_spewe_out = []')
+        writer.write('_spewe_append = _spewe_out.append')
+        for child in self.children:
+            writer.node(child)
+        writer.write("%s = ''.join(_spewe_out)" % content)
+        writer.write('_spewe_out = %s' % out)
+        writer.write('_spewe_append = _spewe_out.append')
+        ttl = writer.expression(ttl)
+        writer.write('_spewe_cache.set(%s, %s, ttl=%s, size=_spewe_len(%s))' % (key, content, ttl, content))
+        writer.dedent()
+        writer.write('_spewe_append(%s)' % content)
+
+    def expressions(self):
+        name, expressions, ttl = self.parse()
+        return [(expression, False) for expression in expressions] + [(ttl, False)]
+
+    def optimize(self, children, in_loop):
+        clone = super(CacheNode, self).optimize(children, in_loop)
+        clone.args = self.parse()
+        return clone
+
+
+class BlockNode(Node, ScopeNodeMixin):
+    """{% block name %}: a section a child template can override"""
+
+    endblock_tag = 'endblock'
+
+    @property
+    def name(self):
+        args = self.token.content.split()[1:]
+        if len(args) != 1:
+            raise self.syntax_error(self.token.raw_content)
+        return args[0]
+
+
+class LoadNode(Node):
+    """{% extends name %} and {% include name %}, resolved when the
+    template is loaded
+    """
+
+    @property
+    def template_name(self):
+        args = self.token.content.split(None, 1)[1:]
+        if not args:
+            raise self.syntax_error(self.token.raw_content)
+        try:
+            name = ast.literal_eval(args[0])
+        except (ValueError, SyntaxError):
+            raise self.syntax_error(self.token.raw_content)
+        if not isinstance(name, str):
+            raise self.syntax_error(self.token.raw_content)
+        return name
+
+    def render(self, context):
+        raise self.syntax_error('<%s> is resolved by a TemplateLoader' % self.token.raw_content)
+
+    def compile(self, writer):
+        raise self.syntax_error('<%s> is resolved by a TemplateLoader' % self.token.raw_content)
+
+
+class ExtendsNode(LoadNode):
+    pass
+
+
+class IncludeNode(LoadNode):
+    pass
 
 
 class ElseNode(Node, ScopeNodeMixin):
@@ -170,17 +471,182 @@ class ElseNode(Node, ScopeNodeMixin):
         return stack
 
 
+class CodeWriter(object):
+    """Accumulates the source code of a compiled template function.
+
+    With profile, nodes and expressions are wrapped in calls to a
+    TemplateProfiler given to the function.
+    """
+
+    def __init__(self, name=None, profile=False):
+        self.lines = []
+        self.level = 1
+        self.counter = 0
+        self.name = name or '<template>'
+        self.profile = profile
+        self.lineno = 0
+        # names of the loop invariants, within an outermost loop
+        self.hoisted = None
+
+    def write(self, line):
+        self.lines.append('    ' * self.level + line)
+
+    def indent(self):
+        self.level += 1
+
+    def dedent(self):
+        self.level -= 1
+
+    def block(self, nodes):
+        self.indent()
+        size = len(self.lines)
+        for node in nodes:
+            self.node(node)
+        if len(self.lines) == size:
+            self.write('pass')
+        self.dedent()
+
+    def new_name(self):
+        self.counter += 1
+        return '_spewe_%d' % self.counter
+
+    def node(self, node):
+        """Write the code of node"""
+        # subtrees coming from a parent or an included template are
+        # profiled under the name of their own file
+        name = self.name
+        self.name = node.template or name
+        try:
+            if not self.profile or node.token is None:
+                node.compile(self)
+            else:
+                lineno, self.lineno = self.lineno, node.token.lineno or 0
+                label = node.label()
+                if len(label) > 60:
+                    label = label[:57] + '...'
+                self.write('_spewe_profiler.enter(%r, _spewe_out)' % ((self.name, self.lineno, label),))
+                node.compile(self)
+                self.write('_spewe_profiler.exit()')
+                self.lineno = lineno
+        except (TemplateSyntaxError,) as exc:
+            if node.token is not None:
+                exc.locate(self.name, node.token.lineno, node.token.col)
+            raise
+        self.name = name
+
+    def expression(self, expr, if_scope=False):
+        """Write the evaluation of expr, mimicking evaluate(), and
+        return the name of the local variable holding its result
+        """
+        parse_expression(expr)
+        hoisted = self.hoisted and self.hoisted.get((expr, if_scope))
+        if hoisted is None:
+            name = self.new_name()
+            self.evaluate(name, expr, if_scope)
+            return name
+        # looked up on its first use only, but still called on each one
+        self.write('if %s is _spewe_unset:' % hoisted)
+        self.indent()
+        self.evaluate(hoisted, expr, if_scope, call=False)
+        self.dedent()
+        name = self.new_name()
+        self.write('%s = %s' % (name, hoisted))
+        self.call(name)
+        return name
+
+    def call(self, name):
+        self.write('if _spewe_callable(%s):' % name)
+        self.indent()
+        self.write('%s = %s()' % (name, name))
+        self.dedent()
+
+    def evaluate(self, name, expr, if_scope, call=True):
+        source = expr.strip()
+        if '#' in source:
+            # keep a trailing comment from swallowing the paren
+            source += '\n'
+        if self.profile:
+            frame = (self.name, self.lineno, 'expr ' + ' '.join(expr.split()))
+            self.write('_spewe_profiler.enter(%r, _spewe_out)' % (frame,))
+        self.write('try:')
+        self.indent()
+        self.write('%s = (%s)' % (name, source))
+        self.dedent()
+        self.write('except _spewe_NameError:')
+        self.indent()
+        if if_scope:
+            self.write('%s = False' % name)
+        else:
+            self.write('raise _spewe_context_error(%r)' % (expr,))
+        self.dedent()
+        self.write('except _spewe_AttributeError as _spewe_exc:')
+        self.indent()
+        self.write('raise _spewe_attribute_error(_spewe_exc.args[0])')
+        self.dedent()
+        if call:
+            self.call(name)
+        if self.profile:
+            self.write('_spewe_profiler.exit()')
+
+    def source(self):
+        header = [
+            'def render(_spewe_context, %s_spewe_str=str, _spewe_callable=callable,'
+            % ('_spewe_profiler, ' if self.profile else ''),
+            '           _spewe_context_error=TemplateContextError,',
+            '           _spewe_attribute_error=TemplateAttributeError,',
+            '           _spewe_NameError=NameError, _spewe_AttributeError=AttributeError,',
+            '           _spewe_cache=fragment_cache, _spewe_len=len, _spewe_unset=UNSET):',
+            '    _spewe_out = []',
+            '    _spewe_append = _spewe_out.append',
+        ]
+        footer = ["    return ''.join(_spewe_out)"]
+        if self.profile:
+            header.append('    _spewe_profiler.start()')
+            header.append('    _spewe_profiler.enter(%r, _spewe_out)' % ((self.name, 0, 'template'),))
+            footer.insert(0, '    _spewe_profiler.exit()')
+        return '\n'.join(header + self.lines + footer)
+
+
+class CompiledTemplate(object):
+    """A template turned into a single python function.
+
+    Expressions in the generated code are plain global lookups, the
+    function being rebound to the rendering context as its globals.
+    """
+
+    def __init__(self, root, name=None, cache=None, profile=False):
+        writer = CodeWriter(name, profile=profile)
+        writer.node(root)
+        self.source = writer.source()
+        namespace = {
+            'TemplateContextError': TemplateContextError,
+            'TemplateAttributeError': TemplateAttributeError,
+            'fragment_cache': cache if cache is not None else fragment_cache,
+            'UNSET': object(),
+        }
+        code = compile(self.source, name or '<template>', 'exec')
+        exec(code, namespace)
+        function = namespace['render']
+        self.code = function.__code__
+        self.defaults = function.__defaults__
+
+    def __call__(self, context, profiler=None):
+        # still not safe though, but it's
+        # better a plain and simple eval
+        context['__builtins__'] = {}
+        render = types.FunctionType(self.code, context, 'render', self.defaults)
+        if profiler is not None:
+            return render(context, profiler)
+        return render(context)
+
+
 class TemplateParser(object):
 
     def __init__(self, template):
         self.template = template
-        self.tokens = self._tokenize()
+        self.tokens = tokenize(template)
         self.root = Node()
 
-    def _tokenize(self):
-        for token in TOKEN_REGEX.split(self.template):
-            yield LToken(token)
-
     def _makenode(self, token):
         content = token.content
         content_type = token.content_type
@@ -192,6 +658,14 @@ class TemplateParser(object):
                 return LoopNode(token)
             elif statement == 'if':
                 return IfNode(token)
+            elif statement == 'cache':
+                return CacheNode(token)
+            elif statement == 'block':
+                return BlockNode(token)
+            elif statement == 'extends':
+                return ExtendsNode(token)
+            elif statement == 'include':
+                return IncludeNode(token)
             else:
                 return ElseNode(token)
         else:
@@ -202,32 +676,191 @@ class TemplateParser(object):
         for token in self.tokens:
             parent_scope = scopes[-1]
             if token.content_type == BLOCK_END:
+                if parent_scope is self.root:
+                    raise TemplateSyntaxError(
+                        '<%s>: no block to close' % token.raw_content).locate(None, token.lineno, token.col)
                 if parent_scope.endblock_tag != token.content:
                     raise TemplateSyntaxError(
-                        '<%s> is an invalid opening block for <%s>' % (parent_scope.token.raw_content, token.raw_content))
+                        '<%s> is an invalid opening block for <%s>' % (parent_scope.token.raw_content, token.raw_content)
+                    ).locate(None, token.lineno, token.col)
                 parent_scope.exit_scope(scopes)
                 continue
             new_node = self._makenode(token)
             parent_scope.children.append(new_node)
-            if token.content_type == BLOCK_START:
+            if isinstance(new_node, ScopeNodeMixin):
                 new_node.enter_scope(scopes)
 
-        if parent_scope is not self.root:
-            raise TemplateSyntaxError('<%s>: block not closed' % parent_scope.token.raw_content)
+        if len(scopes) > 1:
+            token = scopes[-1].token
+            raise TemplateSyntaxError(
+                '<%s>: block not closed' % token.raw_content).locate(None, token.lineno, token.col)
         return self.root
 
     def parse(self):
         return self._nodify()
 
 
+def walk(node):
+    """Yield the descendants of node, depth first"""
+    for child in node.children:
+        yield child
+        for descendant in walk(child):
+            yield descendant
+
+
+def substitute(node, replace):
+    """Copy of the tree rooted at node where each node is swapped for
+    replace(node), the subtree of a swapped node being kept as is.
+    Subtrees left unchanged are shared, not copied.
+    """
+    swapped = replace(node)
+    if swapped is not node or not node.children:
+        return swapped
+    children = [substitute(child, replace) for child in node.children]
+    if all(new is old for new, old in zip(children, node.children)):
+        return node
+    clone = copy.copy(node)
+    clone.children = children
+    return clone
+
+
+def get_blocks(root):
+    """The blocks of the tree by name, outside of the included trees"""
+    blocks = {}
+    for node in root.children:
+        if type(node) is Node and node.template is not None:
+            continue
+        if isinstance(node, BlockNode):
+            blocks.setdefault(node.name, node)
+        for name, block in get_blocks(node).items():
+            blocks.setdefault(name, block)
+    return blocks
+
+
+def get_extends(root):
+    """The {% extends %} node of the tree, if any"""
+    found = None
+    for node in root.children:
+        if isinstance(node, ExtendsNode):
+            if found is not None:
+                raise node.syntax_error('<%s>: template already extended' % node.token.raw_content)
+            found = node
+        elif found is None and not (isinstance(node, TextNode) and not node.token.content.strip()):
+            break
+    for node in walk(root):
+        if isinstance(node, ExtendsNode) and node is not found:
+            raise node.syntax_error('<%s> must be the first tag of the template' % node.token.raw_content)
+    return found
+
+
+if sys.version_info >= (3, 8):
+    LITERAL_NODES = (ast.Constant,)
+else:
+    LITERAL_NODES = tuple(getattr(ast, name) for name in ('Num', 'Str', 'Bytes', 'NameConstant') if hasattr(ast, name))
+# expressions made of these only are evaluated when optimizing
+CONSTANT_NODES = LITERAL_NODES + (
+    ast.Expression, ast.Load, ast.Tuple, ast.List, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not,
+    ast.USub, ast.UAdd, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn,
+    ast.Is, ast.IsNot)
+
+
+def parse_expression(expression):
+    """Syntax tree of a template expression"""
+    tree = expression_cache.get(expression)
+    if tree is None:
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except (SyntaxError,):
+            raise TemplateSyntaxError(expression)
+        expression_cache.set(expression, tree)
+    return tree
+
+
+def constant(expression):
+    """Value of an expression made of literals, raise ValueError otherwise"""
+    tree = parse_expression(expression)
+    if not all(isinstance(node, CONSTANT_NODES) for node in ast.walk(tree)):
+        raise ValueError(expression)
+    return eval(compile(tree, '<template>', 'eval'), {'__builtins__': {}})
+
+
+def is_string(expression):
+    """Whether the expression always gives a string: a formatting of a
+    string literal or an f-string
+    """
+    body = parse_expression(expression).body
+    if isinstance(body, ast.BinOp) and isinstance(body.op, ast.Mod):
+        body = body.left
+    if isinstance(body, LITERAL_NODES):
+        return isinstance(getattr(body, 'value', getattr(body, 's', None)), str)
+    return type(body).__name__ == 'JoinedStr'
+
+
+def get_names(expression):
+    """Names the expression looks up in the context"""
+    return set(node.id for node in ast.walk(parse_expression(expression)) if isinstance(node, ast.Name))
+
+
+def has_calls(expression):
+    """Whether the expression calls anything, which may have side effects"""
+    return any(isinstance(node, ast.Call) for node in ast.walk(parse_expression(expression)))
+
+
+def optimize(node, in_loop=False):
+    """Frozen copy of the tree rooted at node, which can be shared by
+    threads and renderings: adjacent texts are merged, literal values
+    and conditions are folded and branches computed once.
+    """
+    children = []
+
+    def add(child):
+        if type(child) is Node and child.template is None:
+            # a folded condition, or a plain container
+            for grandchild in child.children:
+                add(grandchild)
+        elif isinstance(child, TextNode) and children and isinstance(children[-1], TextNode):
+            token = children[-1].token
+            text = TextNode(token._replace(content=token.content + child.token.content,
+                                           raw_content=token.raw_content + child.token.raw_content))
+            text.children = ()
+            children[-1] = text
+        else:
+            children.append(child)
+
+    try:
+        for child in node.children:
+            child = optimize(child, in_loop or isinstance(node, LoopNode))
+            if child is not None:
+                add(child)
+        node = node.optimize(children, in_loop)
+    except (TemplateSyntaxError,) as exc:
+        if node.token is not None:
+            exc.locate(None, node.token.lineno, node.token.col)
+        raise exc.locate(node.template)
+    if node is not None:
+        node.children = tuple(node.children)
+    return node
+
+
 class Template(object):
 
-    def __init__(self, name=None, content=None, context=None):
+    def __init__(self, name=None, content=None, context=None, cache=None, loader=None):
         self.name = name
         self.content = content
         if not context:
             context = {}
         self.context = context
+        # store of the {% cache %} fragments, fragment_cache by default
+        self.cache = cache
+        # resolves {% extends %} and {% include %}, a loader of the
+        # directory of the template by default
+        self.loader = loader
+        # paths of the templates extended or included, recursively
+        self.dependencies = set()
+        self._tree = None
+        self._optimized = None
+        self._compiled = None
+        self._profiled = None
 
     def load(self):
         try:
@@ -241,9 +874,188 @@ class Template(object):
     def parser(self):
         return TemplateParser(self.content)
 
-    def render(self, context=None):
-        if not self.content and self.name:
-            self.load()
+    def resolve(self):
+        """Parse the template into a single tree: {% include %} nodes are
+        replaced by the tree of the named template and, with {% extends %},
+        the tree of the parent is used with the blocks of this one
+        """
+        root = self.parser.parse()
+        dependencies = set()
+
+        def load(node):
+            if self.loader is None:
+                self.loader = TemplateLoader(os.path.dirname(self.name or ''))
+            template = self.loader.get_template(node.template_name)
+            dependencies.add(template.name)
+            dependencies.update(template.dependencies)
+            return template
+
+        def include(node):
+            if not isinstance(node, IncludeNode):
+                return node
+            template = load(node)
+            container = Node()
+            container.template = template.name
+            container.children = [template.tree]
+            return container
+
+        def own_block(node):
+            if not isinstance(node, BlockNode):
+                return node
+            # copied, the nodes of the parsed trees are shared
+            block = copy.copy(node)
+            block.template = self.name
+            block.children = [substitute(child, own_block) for child in node.children]
+            return block
+
+        extends = get_extends(root)
+        if extends is not None and self.name:
+            root = substitute(root, own_block)
+        root = substitute(root, include)
+        if extends is not None:
+            blocks = get_blocks(root)
+            parent = load(extends)
+            container = Node()
+            container.template = parent.name
+            container.children = [substitute(parent.tree, lambda node: blocks.get(node.name, node)
+                                             if isinstance(node, BlockNode) else node)]
+            root = container
+        self.dependencies = dependencies
+        return root
+
+    @property
+    def tree(self):
+        """The resolved node tree of the template"""
+        if self._tree is None:
+            if not self.content and self.name:
+                self.load()
+            try:
+                self._tree = self.resolve()
+            except (TemplateSyntaxError,) as exc:
+                raise exc.locate(self.name)
+        return self._tree
+
+    @property
+    def optimized(self):
+        """The frozen tree the template is compiled from"""
+        if self._optimized is None:
+            try:
+                self._optimized = optimize(self.tree)
+            except (TemplateSyntaxError,) as exc:
+                raise exc.locate(self.name)
+        return self._optimized
+
+    def compile(self):
+        if self._compiled is None:
+            self._compiled = CompiledTemplate(self.optimized, self.name, cache=self.cache)
+        return self._compiled
+
+    def compile_profiled(self):
+        """Compile the template instrumented for a TemplateProfiler"""
+        if self._profiled is None:
+            self._profiled = CompiledTemplate(self.optimized, self.name, cache=self.cache, profile=True)
+        return self._profiled
+
+    def render(self, context=None, profiler=None):
+        """Render the template, timing its nodes and expressions in
+        profiler when given
+        """
+        render_context = dict(self.context)
         if context:
-            self.context.update(context)
-        return self.parser.parse().render(context)
+            render_context.update(context)
+        if profiler is not None:
+            return self.compile_profiled()(render_context, profiler)
+        return self.compile()(render_context)
+
+
+class TemplateLoader(object):
+    """Keeps compiled templates in memory, keyed on their absolute path.
+
+    At most `max_size` templates are kept (least recently used ones are
+    evicted first). When `check_interval` is set, the file modification
+    time is checked at most every `check_interval` seconds and stale
+    templates are reloaded; when it's None, templates never expire.
+    `cache` is the store of the {% cache %} fragments.
+
+    {% extends %} and {% include %} are resolved relative to `directory`
+    when a template is loaded: each is compiled into one function, so
+    rendering never touches the files it depends on. A template is
+    stale as soon as one of them is modified.
+    """
+
+    def __init__(self, directory='', max_size=128, check_interval=None, cache=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.cache = cache
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+        # paths being loaded by the current thread
+        self._local = threading.local()
+
+    def get_path(self, name):
+        return os.path.abspath(os.path.join(self.directory, name))
+
+    def _get_mtime(self, path):
+        try:
+            stat = os.stat(path)
+        except (OSError,):
+            raise TemplateNotFound(path)
+        return stat.st_mtime, stat.st_size
+
+    def _load(self, path):
+        loading = getattr(self._local, 'paths', None)
+        if loading is None:
+            loading = self._local.paths = []
+        if path in loading:
+            raise TemplateSyntaxError('%s: circular extends or include' % path)
+        loading.append(path)
+        try:
+            mtimes = {path: self._get_mtime(path)}
+            template = Template(path, cache=self.cache, loader=self)
+            template.compile()
+        finally:
+            loading.pop()
+        for dependency in template.dependencies:
+            mtimes[dependency] = self._get_mtime(dependency)
+        return [template, mtimes, time.time()]
+
+    def _is_stale(self, path, entry):
+        if self.check_interval is None:
+            return False
+        now = time.time()
+        if now - entry[2] < self.check_interval:
+            return False
+        entry[2] = now
+        # editing an extended or included template expires this one too
+        try:
+            return any(self._get_mtime(p) != mtime for p, mtime in entry[1].items())
+        except (TemplateNotFound,):
+            return True
+
+    def get_template(self, name):
+        path = self.get_path(name)
+        with self._lock:
+            entry = self._templates.pop(path, None)
+            if entry is not None:
+                if not self._is_stale(path, entry):
+                    self._templates[path] = entry
+                    return entry[0]
+                # reload the dependencies as well, whatever their last check
+                for dependency in entry[0].dependencies:
+                    self._templates.pop(dependency, None)
+        entry = self._load(path)
+        with self._lock:
+            self._templates[path] = entry
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+        return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+
+# templates are never reloaded: in DEBUG, apps render through a loader
+# of their own checking the files
+default_loader = TemplateLoader()
@@ -17,8 +17,16 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-from spewe.template import Template
+try:
+    from inspect import iscoroutinefunction
+except (ImportError,):
+    def iscoroutinefunction(func):
+        return False
 
+from spewe.template import default_loader
 
-def render_template(template, context):
-    return Template(template).render(context)
+
+def render_template(template, context, loader=None, profiler=None):
+    if loader is None:
+        loader = default_loader
+    return loader.get_template(template).render(context, profiler=profiler)
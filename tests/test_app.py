@@ -1,11 +1,23 @@
+import datetime
+import gzip
+import io
+import threading
+import time
 import wsgiref
+import zlib
 
-from spewe import http
-from spewe import Settings, Spewe
+import pytest
+
+from spewe import exceptions, http
+from spewe import Route, Settings, Spewe
+from spewe.cache import CachePolicy, LRUCache
+from spewe.multipart import MultipartParser, parse_urlencoded
+from spewe.routing import Router
+from spewe import serializers
 
 import utils
 
-from webtest import Upload
+from webtest import TestApp, Upload
 
 
 def test_request():
@@ -50,6 +62,87 @@ def test_request():
     assert request.build_absolute_uri(uuid) == "http://localhost:8099/%s" % uuid
 
 
+def test_lazy_request():
+
+    class UnreadableInput(object):
+
+        def read(self, *args):
+            raise AssertionError('body must not be read')
+
+        readline = read
+
+    env = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/users',
+           'QUERY_STRING': 'username=toto', 'HTTP_HOST': 'localhost',
+           'CONTENT_TYPE': 'application/x-www-form-urlencoded', 'CONTENT_LENGTH': '12'}
+    wsgiref.util.setup_testing_defaults(env)
+    env['wsgi.input'] = UnreadableInput()
+    request = http.Request(env)
+    assert not hasattr(request, '__dict__')
+    assert request.path == '/users'
+    for slot in ('_params', '_headers', '_form', '_files', '_body'):
+        assert not hasattr(request, slot)
+    assert request.params == {'username': ['toto']}
+    assert request.params is request.params
+    assert request.headers['HTTP_HOST'] == 'localhost'
+    with pytest.raises(AssertionError):
+        request.form
+
+
+def test_request_body():
+
+    class NonSeekableInput(object):
+
+        def __init__(self, data):
+            self.fp = io.BytesIO(data)
+            self.reads = 0
+
+        def read(self, size=-1):
+            self.reads += 1
+            return self.fp.read(size)
+
+    env = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': 'text/plain; charset=utf-8',
+           'CONTENT_LENGTH': '5'}
+    wsgiref.util.setup_testing_defaults(env)
+    env['wsgi.input'] = NonSeekableInput(b'caf\xc3\xa9 and what comes next')
+    request = http.Request(env)
+    assert request.body == u'caf\xe9'
+    assert request.data == b'caf\xc3\xa9'
+    assert list(request.stream) == [b'caf\xc3\xa9']
+    assert env['wsgi.input'].reads == 1
+    # streaming without keeping the body
+    env['wsgi.input'] = NonSeekableInput(b'abcdef')
+    env['CONTENT_LENGTH'] = '6'
+    request = http.Request(env)
+    assert b''.join(request.stream) == b'abcdef'
+    with pytest.raises(exceptions.SpeweException):
+        request.data
+    # unknown length is bounded by max_body_size
+    env['CONTENT_LENGTH'] = ''
+    env['wsgi.input_terminated'] = True
+    env['wsgi.input'] = NonSeekableInput(b'a' * 100)
+    with pytest.raises(exceptions.RequestEntityTooLarge):
+        http.Request(env, max_body_size=10).data
+    # an urlencoded form is read once, the body remains available
+    env['CONTENT_TYPE'] = 'application/x-www-form-urlencoded'
+    env['CONTENT_LENGTH'] = '14'
+    env['wsgi.input'] = NonSeekableInput(b'name=caf%C3%A9')
+    request = http.Request(env)
+    assert request.form == {'name': u'caf\xe9'}
+    assert request.body == u'name=caf%C3%A9' and request.data == b'name=caf%C3%A9'
+
+
+def test_max_body_size():
+    testapp = Spewe(settings={'MAX_BODY_SIZE': 10})
+
+    @testapp.route('/echo', methods=['POST'])
+    def echo(request):
+        return request.body
+
+    app = TestApp(testapp)
+    assert app.post('/echo', params=b'0123456789').text == '0123456789'
+    assert app.post('/echo', params=b'0123456789+', status=413).text == 'Request entity too large'
+
+
 def test_none_response(app):
     app.get('/none/', status=204)
 
@@ -70,6 +163,22 @@ def test_response_default_headers(app):
     assert 'Date' in resp.headers
 
 
+def test_response_framing(monkeypatch):
+    assert http.status.describe(404) == '404 NOT FOUND'
+    assert http.status.describe(http.status.HTTP_200_OK) == '200 OK'
+    assert http.status.describe(299) == '299 UNKNOWN'
+    monkeypatch.setattr(time, 'time', lambda: 1500000000.5)
+    assert http.http_now() is http.http_now()
+    monkeypatch.setattr(time, 'time', lambda: 1500000001.0)
+    assert http.http_now() == 'Fri, 14 Jul 2017 02:40:01 GMT'
+    response = http.Response('Hello')
+    response.add_header('X-Spewe', 'yes')
+    assert response.headerlist == [('Content-Type', 'text/html; charset=UTF8'), ('X-Spewe', 'yes')]
+    assert response.get_header('x-spewe') == 'yes'
+    response.headers['X-Spewe'] = 'no'
+    assert response.headerlist[-1] == ('X-Spewe', 'no')
+
+
 def test_response_as_str(app):
     resp = app.get('/index', status=200)
     assert resp.content_type == 'text/html'
@@ -101,6 +210,47 @@ def test_form_submission_with_file(app):
     assert resp.html.find('p', {'class': 'note-content'}).text.strip() == filecontent.decode()
 
 
+def test_multipart_parser():
+    boundary = '----spewe'
+    binary = bytes(bytearray(range(256))) * 40
+    body = b''.join([
+        b'preamble\r\n------spewe\r\n',
+        b'Content-Disposition: form-data; name="description"\r\n\r\n',
+        'caf\xe9 --\r\n-- ----spew'.encode('utf-8'),
+        b'\r\n------spewe\r\n',
+        b'Content-Disposition: form-data; name="note"; filename="note.bin"\r\n',
+        b'Content-Type: application/octet-stream\r\n\r\n',
+        binary,
+        b'\r\n------spewe--\r\n',
+    ])
+    parser = MultipartParser(io.BytesIO(body), boundary, len(body), chunk_size=7, spool_size=1024)
+    form, files = parser.parse()
+    assert form == {'description': 'caf\xe9 --\r\n-- ----spew'}
+    note = files['note']
+    assert note.filename == 'note.bin' and note.content_type == 'application/octet-stream'
+    assert note.size == len(binary) and note.data == binary
+    # the file went to disk past spool_size
+    assert note.file._rolled
+    # streaming callbacks get the content instead of the spooled file
+    events = []
+    parser = MultipartParser(io.BytesIO(body), boundary, len(body),
+                             on_file_begin=lambda xfile: events.append(xfile.filename),
+                             on_file_data=lambda xfile, chunk: events.append(len(chunk)),
+                             on_file_end=lambda xfile: events.append(xfile.size))
+    form, files = parser.parse()
+    assert events == ['note.bin', len(binary), len(binary)]
+    assert files['note'].data == b''
+    with pytest.raises(exceptions.BadRequest):
+        MultipartParser(io.BytesIO(body[:-40]), boundary, len(body) - 40).parse()
+
+
+def test_urlencoded_parser():
+    body = b'username=cartman&bio=caf%C3%A9+%26+more&empty=&username=kenny'
+    form, files = parse_urlencoded(io.BytesIO(body + b'&ignored=1'), len(body), chunk_size=5)
+    assert form == {'username': 'cartman', 'bio': u'caf\xe9 & more', 'empty': ''}
+    assert files == {}
+
+
 def test_url_argument_parsing(app):
     resp = app.get('/users/120u12a/', status=200)
     assert resp.text == '120u12a'
@@ -129,6 +279,413 @@ def test_json_payload(app):
     assert resp.json[1]['uuid'] == 'aabb' * 8
 
 
+def test_json_backends():
+    request = http.Request({'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': 'application/json; charset=utf-8',
+                            'CONTENT_LENGTH': '14', 'wsgi.input': io.BytesIO(b'{"name": "\xc3\xa9"}')})
+    assert request.json == {'name': u'\xe9'}
+    # the body isn't parsed again
+    assert request.json is request.json
+    response = http.JsonResponse({'name': u'\xe9'})
+    assert isinstance(response.data, bytes)
+    for name in ('auto', 'json'):
+        backend = serializers.get_backend(name)
+        assert backend.loads(backend.dumps([1, {'a': u'\xe9'}])) == [1, {'a': u'\xe9'}]
+    with pytest.raises(ValueError):
+        serializers.get_backend('yaml')
+
+
+def test_json_stream_response():
+    testapp = Spewe()
+
+    @testapp.route('/export')
+    def export(request):
+        return http.JsonStreamResponse({'id': i} for i in range(3))
+
+    @testapp.route('/lines')
+    def export_lines(request):
+        return http.JsonStreamResponse(({'id': i} for i in range(3)), ndjson=True)
+
+    closed = []
+
+    class Rows(object):
+
+        def __iter__(self):
+            return iter([{'id': 0}])
+
+        def close(self):
+            closed.append(True)
+
+    @testapp.route('/rows')
+    def export_rows(request):
+        return http.JsonStreamResponse(Rows())
+
+    app = TestApp(testapp)
+    # the source is closed along with the response
+    assert app.get('/rows').json == [{'id': 0}] and closed == [True]
+    resp = app.get('/export')
+    assert resp.content_type == 'application/json'
+    assert resp.json == [{'id': 0}, {'id': 1}, {'id': 2}]
+    resp = app.get('/lines')
+    assert resp.content_type == 'application/x-ndjson'
+    assert resp.body == b'{"id": 0}\n{"id": 1}\n{"id": 2}\n'
+    assert list(serializers.iter_json([], ndjson=False)) == [b'[]']
+    chunks = list(serializers.iter_json(range(6), chunk_size=4))
+    assert chunks == [b'[0,1', b',2,3', b',4,5', b']']
+
+
+def test_streaming_response():
+    testapp = Spewe()
+    closed = []
+
+    @testapp.route('/export')
+    def export(request):
+        def rows():
+            try:
+                for i in range(3):
+                    yield 'row %d\n' % i if i % 2 else b'bytes row\n'
+            finally:
+                closed.append(True)
+        return http.StreamingResponse(rows(), content_type='text/plain')
+
+    app = TestApp(testapp)
+    resp = app.get('/export')
+    assert resp.body == b'bytes row\nrow 1\nbytes row\n'
+    assert resp.headers['Content-Type'] == 'text/plain'
+    assert closed == [True]
+
+
+def test_file_response(tmpdir):
+    path = tmpdir.join('export.csv')
+    path.write_binary(b'id,name\n1,kenny\n')
+    testapp = Spewe()
+
+    @testapp.route('/download')
+    def download(request):
+        return http.FileResponse(str(path), as_attachment=True)
+
+    app = TestApp(testapp)
+    resp = app.get('/download')
+    assert resp.body == b'id,name\n1,kenny\n'
+    assert resp.headers['Content-Length'] == '16'
+    assert resp.headers['Content-Type'] == 'text/csv; charset=UTF8'
+    assert resp.headers['Content-Disposition'] == 'attachment; filename="export.csv"'
+    # the file is handed to the server file wrapper, torn down once closed
+    calls = []
+
+    @testapp.teardown
+    def teardown(request, exception):
+        calls.append('teardown')
+
+    env = {}
+    wsgiref.util.setup_testing_defaults(env)
+    env['PATH_INFO'] = '/download'
+    env['wsgi.file_wrapper'] = wsgiref.util.FileWrapper
+    body = testapp(env, lambda status, headers: None)
+    assert isinstance(body, wsgiref.util.FileWrapper)
+    assert b''.join(body) == b'id,name\n1,kenny\n' and calls == []
+    body.close()
+    assert body.filelike.closed and calls == ['teardown']
+
+
+def test_static_files(tmpdir):
+    tmpdir.mkdir('css').join('style.css').write('body { color: red; }')
+    tmpdir.join('css', 'style.css.gz').write_binary(gzip.compress(b'body { color: red; }'))
+    tmpdir.join('secret.txt').write('secret')
+    testapp = Spewe(settings={'STATIC_DIR': str(tmpdir.join('css')), 'STATIC_URL': '/assets/'})
+    app = TestApp(testapp)
+    resp = app.get('/assets/style.css')
+    assert resp.body == b'body { color: red; }'
+    assert resp.headers['Content-Type'] == 'text/css; charset=UTF8'
+    assert resp.headers['Cache-Control'] == 'public, max-age=3600'
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    assert 'Content-Encoding' not in resp.headers
+    etag = resp.headers['ETag']
+    # the pre-compressed sibling is picked
+    env = {'PATH_INFO': '/assets/style.css', 'HTTP_ACCEPT_ENCODING': 'br;q=0, gzip, deflate'}
+    wsgiref.util.setup_testing_defaults(env)
+    headers = {}
+    body = testapp(env, lambda status, response_headers: headers.update(response_headers))
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(b''.join(body)) == b'body { color: red; }'
+    assert headers['ETag'] != etag
+    body.close()
+    # conditional requests
+    resp = app.get('/assets/style.css', headers={'If-None-Match': etag}, status=304)
+    assert resp.body == b''
+    app.get('/assets/style.css', headers={'If-Modified-Since': resp.headers['Last-Modified']}, status=304)
+    app.get('/assets/style.css', headers={'If-None-Match': '"other"'}, status=200)
+    app.get('/assets/../secret.txt', status=404)
+    app.get('/assets/none.css', status=404)
+    app.post('/assets/style.css', status=405)
+
+
+def test_compression():
+    testapp = Spewe(settings={'COMPRESSION': True, 'COMPRESSION_MIN_SIZE': 100})
+    html = '<p>%s</p>' % ('spewe ' * 100)
+
+    @testapp.route('/page')
+    def page(request):
+        return html
+
+    @testapp.route('/small')
+    def small(request):
+        return 'small'
+
+    @testapp.route('/image')
+    def image(request):
+        return http.Response(b'\x89PNG' * 100, content_type='image/png')
+
+    @testapp.route('/stream')
+    def stream(request):
+        return http.StreamingResponse(iter(['<p>%d</p>' % i for i in range(100)]))
+
+    status, headers, body = utils.call(testapp, '/page', HTTP_ACCEPT_ENCODING='gzip, deflate')
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(body) == html.encode('utf-8')
+    status, headers, body = utils.call(testapp, '/page', HTTP_ACCEPT_ENCODING='deflate')
+    assert zlib.decompress(body) == html.encode('utf-8')
+    status, headers, body = utils.call(testapp, '/page')
+    assert 'Content-Encoding' not in headers and headers['Vary'] == 'Accept-Encoding'
+    for path in ('/small', '/image'):
+        status, headers, body = utils.call(testapp, path, HTTP_ACCEPT_ENCODING='gzip')
+        assert 'Content-Encoding' not in headers
+    status, headers, body = utils.call(testapp, '/stream', HTTP_ACCEPT_ENCODING='gzip')
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(body) == ''.join('<p>%d</p>' % i for i in range(100)).encode('utf-8')
+
+
+def test_conditional_get():
+    testapp = Spewe(settings={'ETAGS': True})
+    calls = []
+
+    @testapp.route('/page')
+    def page(request):
+        return 'Hello Kenny'
+
+    def article_validator(request, slug):
+        if slug == 'missing':
+            raise exceptions.Http404('No such article')
+        return slug, datetime.datetime(2017, 6, 1, 12, 0)
+
+    @testapp.route(r'^/articles/(?P<slug>[\w-]+)$', validator=article_validator)
+    def article(request, slug):
+        calls.append(slug)
+        return 'Article %s' % slug
+
+    app = TestApp(testapp)
+    resp = app.get('/page')
+    etag = resp.headers['ETag']
+    resp = app.get('/page', headers={'If-None-Match': etag}, status=304)
+    assert resp.body == b'' and resp.headers['ETag'] == etag
+    app.get('/page', headers={'If-None-Match': '"stale"'}, status=200)
+
+    resp = app.get('/articles/spewe')
+    assert resp.headers['ETag'] == '"spewe"'
+    assert resp.headers['Last-Modified'] == 'Thu, 01 Jun 2017 12:00:00 GMT'
+    assert calls == ['spewe']
+    # fresh copies don't reach the view
+    app.get('/articles/spewe', headers={'If-None-Match': 'W/"spewe"'}, status=304)
+    app.get('/articles/spewe', headers={'If-Modified-Since': 'Thu, 01 Jun 2017 13:00:00 GMT'}, status=304)
+    assert calls == ['spewe']
+    app.get('/articles/spewe', headers={'If-Modified-Since': 'Thu, 01 Jun 2017 11:00:00 GMT'}, status=200)
+    assert calls == ['spewe', 'spewe']
+    # validators may refuse the request like views
+    assert app.get('/articles/missing', status=404).text == 'No such article'
+    assert calls == ['spewe', 'spewe']
+
+
+def test_lru_cache():
+    cache = LRUCache(max_size=10)
+    cache.set('a', 'A', size=4)
+    cache.set('b', 'B', size=4)
+    assert cache.get('a') == 'A'
+    # b is the least recently used
+    cache.set('c', 'C', size=4)
+    assert 'b' not in cache and cache.get('a') == 'A' and cache.size == 8
+    cache.set('d', 'D', size=11)
+    assert 'd' not in cache
+    cache.set('e', 'E', ttl=-1)
+    assert cache.get('e') is None and cache.size == 8
+    cache.evict(lambda key: key in ('a', 'c'))
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_response_cache():
+    testapp = Spewe()
+    calls = []
+
+    @testapp.route('/news', cache=60)
+    def news(request):
+        calls.append(request.query_string)
+        return 'News %d' % len(calls)
+
+    @testapp.route('/menu', name='menu', cache=CachePolicy(60, query=['page'], headers=['Accept-Language']))
+    def menu(request):
+        calls.append('menu')
+        return 'Menu %d' % len(calls)
+
+    def stamp(request, response):
+        response.add_header('X-Stamp', str(len(calls)))
+
+    @testapp.route('/stamped', cache=60, after=[stamp])
+    def stamped(request):
+        calls.append('stamped')
+        return 'Stamped'
+
+    @testapp.route('/slow', cache=60)
+    def slow(request):
+        time.sleep(0.1)
+        calls.append('slow')
+        return 'Slow'
+
+    app = TestApp(testapp)
+    assert app.get('/news').text == 'News 1'
+    assert app.get('/news').text == 'News 1'
+    assert app.get('/news?page=2').text == 'News 2'
+    assert app.get('/news', headers={'If-None-Match': '"none"'}).headers['Content-Length'] == '6'
+
+    assert app.get('/menu?page=1&utm=a').text == 'Menu 3'
+    assert app.get('/menu?utm=b&page=1').text == 'Menu 3'
+    assert app.get('/menu?page=1', headers={'Accept-Language': 'fr'}).text == 'Menu 4'
+    testapp.invalidate_cache('menu')
+    assert app.get('/menu?page=1').text == 'Menu 5'
+    assert app.get('/news').text == 'News 1'
+    # the route after hooks also apply to the cached responses
+    assert app.get('/stamped').headers['X-Stamp'] == '6'
+    resp = app.get('/stamped')
+    assert resp.text == 'Stamped' and resp.headers.getall('X-Stamp') == ['6']
+
+    # a single regeneration at a time
+    del calls[:]
+    threads = [threading.Thread(target=app.get, args=('/slow',)) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert calls == ['slow']
+
+
+def test_request_timing(tmpdir):
+    tmpdir.join('hello.html').write('Hello {{name}}')
+    testapp = Spewe(settings={'TEMPLATE_DIR': str(tmpdir), 'SERVER_TIMING': True, 'STATS_URL': '/_stats'})
+
+    @testapp.route('/hello', template='hello.html')
+    def hello(request, context):
+        context['name'] = 'Kenny'
+        return http.TemplateResponse(context)
+
+    app = TestApp(testapp)
+    for _ in range(3):
+        resp = app.get('/hello')
+    phases = [entry.split(';')[0] for entry in resp.headers['Server-Timing'].split(', ')]
+    assert phases == ['request', 'routing', 'view', 'render', 'encode', 'total']
+    app.get('/nowhere', status=404)
+    stats = app.get('/_stats').json
+    assert stats['hello']['total']['count'] == 3
+    assert sorted(stats['hello']) == ['encode', 'render', 'request', 'routing', 'total', 'view']
+    summary = stats['hello']['total']
+    assert 0 < summary['p50'] <= summary['p95'] <= summary['p99'] <= summary['max']
+    assert stats['(unmatched)']['total']['count'] == 1
+    testapp.stats.reset()
+    assert testapp.stats.summary() == {}
+    # disabled by default
+    assert Spewe().stats is None
+
+
+def test_request_hooks():
+    testapp = Spewe()
+    calls = []
+
+    @testapp.before_request
+    def authenticate(request):
+        calls.append('before')
+        if request.headers.get('HTTP_AUTHORIZATION') != 'token':
+            return http.Response('Unauthorized', status_code=401)
+        request.state['user'] = 'kenny'
+
+    @testapp.after_request
+    def add_header(request, response):
+        calls.append('after')
+        response.add_header('X-Frame-Options', 'DENY')
+
+    @testapp.teardown
+    def teardown(request, exception):
+        calls.append(('teardown', exception))
+
+    def audit(request, response):
+        calls.append('audit')
+        return http.Response(response.content.upper(), status_code=response.status_code)
+
+    @testapp.route('/me', after=[audit])
+    def me(request):
+        calls.append('view')
+        return 'Hello %s' % request.state['user']
+
+    @testapp.route('/fail')
+    def fail(request):
+        raise ValueError('boom')
+
+    assert testapp.routes[0].before_hooks == (authenticate,)
+    assert testapp.routes[0].after_hooks == (audit, add_header)
+    app = TestApp(testapp)
+    resp = app.get('/me', headers={'Authorization': 'token'})
+    assert resp.text == 'HELLO KENNY'
+    assert resp.headers['X-Frame-Options'] == 'DENY'
+    assert calls == ['before', 'view', 'audit', 'after', ('teardown', None)]
+    del calls[:]
+    # short-circuited requests skip the view
+    resp = app.get('/me', status=401)
+    assert resp.headers['X-Frame-Options'] == 'DENY'
+    assert calls == ['before', 'audit', 'after', ('teardown', None)]
+    del calls[:]
+    resp = app.get('/nowhere', status=404)
+    assert resp.headers['X-Frame-Options'] == 'DENY'
+    del calls[:]
+    with pytest.raises(ValueError):
+        app.get('/fail', headers={'Authorization': 'token'})
+    assert calls[-1][0] == 'teardown' and isinstance(calls[-1][1], ValueError)
+
+
+def test_request_hooks_guard_views():
+    testapp = Spewe()
+    calls = []
+
+    def authenticate(request):
+        calls.append('auth')
+        if request.headers.get('HTTP_AUTHORIZATION') != 'token':
+            raise exceptions.PermissionDenied('nope')
+
+    @testapp.teardown
+    def teardown(request, exception):
+        calls.append('teardown')
+
+    @testapp.route('/doc', validator=lambda request: ('"v1"', None), before=[authenticate])
+    def doc(request):
+        return 'doc'
+
+    @testapp.route('/rows', before=[authenticate])
+    def rows(request):
+        def generate():
+            for row in ('a', 'b'):
+                calls.append(row)
+                yield row
+        return http.StreamingResponse(generate())
+
+    app = TestApp(testapp)
+    resp = app.get('/doc', status=403)
+    assert resp.text == 'nope'
+    # conditional requests go through the hooks as well
+    resp = app.get('/doc', headers={'If-None-Match': '"v1"'}, status=403)
+    assert 'ETag' not in resp.headers and calls.count('auth') == 2
+    resp = app.get('/doc', headers={'If-None-Match': '"v1"', 'Authorization': 'token'}, status=304)
+    assert resp.headers['ETag'] == '"v1"'
+    del calls[:]
+    # streamed bodies are torn down once sent
+    assert app.get('/rows', headers={'Authorization': 'token'}).text == 'ab'
+    assert calls == ['auth', 'a', 'b', 'teardown']
+
+
 def test_response_redirect(app):
     url = 'https://example.net/'
     response = http.ResponsePermanentRedirect(url)
@@ -152,3 +709,31 @@ def test_app_settings():
     assert app.settings.DEBUG is True
     assert app.settings.TEMPLATE_DIR == 'templates'
     assert app.settings.STATIC_DIR == 'statics'
+
+
+def test_router():
+    router = Router()
+    for url, methods in [('/index', ['get']), (r'^/users/(?P<uuid>\w+)/$', ['get']),
+                         (r'^/users/(?P<uuid>\w+)/notes/(?P<note>\d+)$', ['post']),
+                         (r'^/(?P<a>x)(?P=a)/$', ['get']), (r'^/(y)\1/$', ['get']),
+                         ('/users/me/', ['put'])]:
+        router.add(Route(url, methods, lambda request: None))
+    match = router.match('/index')
+    assert match.route.url == '/index' and match.params == {}
+    # prefix matching, just like re.match
+    assert router.match('/index/').route.url == '/index'
+    match = router.match('/users/120u12a/notes/12')
+    assert match.params == {'uuid': '120u12a', 'note': '12'}
+    assert match.methods == frozenset(['post'])
+    assert router.match('/xx/').params == {'a': 'x'}
+    assert router.match('/yy/').route.url == r'^/(y)\1/$'
+    # earlier routes shadow literal ones
+    match = router.match('/users/me/')
+    assert match.route.url == r'^/users/(?P<uuid>\w+)/$'
+    assert match.params == {'uuid': 'me'}
+    assert router.match('/none/') is None
+
+
+def test_405_allow_header(app):
+    resp = app.post('/index', status=405)
+    assert resp.headers['Allow'] == 'GET'
@@ -0,0 +1,130 @@
+import asyncio
+import threading
+import time
+
+from spewe import Spewe
+from spewe.http import StreamingResponse
+
+from utils import call
+
+
+def make_app():
+    app = Spewe(settings={'MAX_BODY_SIZE': 16})
+
+    @app.route(r'^/async/(?P<name>\w+)$')
+    async def hello(request, name):
+        await asyncio.sleep(0.1)
+        return 'Hello %s' % name
+
+    @app.route('/sync')
+    def sync(request):
+        return threading.current_thread().name
+
+    @app.route('/echo', methods=['POST'])
+    async def echo(request):
+        return request.body.upper()
+
+    @app.route('/stream')
+    async def stream(request):
+        async def chunks():
+            for word in ('one', 'two', 'three'):
+                await asyncio.sleep(0)
+                yield word
+        return StreamingResponse(chunks())
+
+    return app
+
+
+def scope(path, method='GET', headers=()):
+    return {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': method, 'scheme': 'http', 'path': path, 'query_string': b'',
+            'root_path': '', 'headers': list(headers), 'server': ('testserver', 80),
+            'client': ('127.0.0.1', 5000)}
+
+
+async def asgi_call(app, path, method='GET', chunks=(b'',), headers=()):
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope(path, method, headers), receive, send)
+    start, bodies = sent[0], sent[1:]
+    assert bodies[-1].get('more_body', False) is False
+    return start['status'], dict(start['headers']), [m.get('body', b'') for m in bodies]
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_asgi_views():
+    app = make_app()
+    status, headers, body = run(asgi_call(app, '/async/josue'))
+    assert status == 200
+    assert body == [b'Hello josue']
+    assert headers[b'content-length'] == b'11'
+    # plain views run in the thread pool
+    status, headers, body = run(asgi_call(app, '/sync'))
+    assert body != [threading.current_thread().name.encode()]
+    assert run(asgi_call(app, '/nowhere'))[0] == 404
+    assert run(asgi_call(app, '/sync', method='POST'))[0] == 405
+
+
+def test_asgi_concurrency():
+    app = make_app()
+
+    async def gather():
+        return await asyncio.gather(*[asgi_call(app, '/async/n%d' % i) for i in range(20)])
+
+    start = time.time()
+    results = run(gather())
+    assert time.time() - start < 1
+    assert [body for _, _, body in results] == [[b'Hello n%d' % i] for i in range(20)]
+
+
+def test_asgi_request_body():
+    app = make_app()
+    headers = [(b'content-type', b'text/plain')]
+    status, _, body = run(asgi_call(app, '/echo', 'POST', [b'hello ', b'world'], headers))
+    assert body == [b'HELLO WORLD']
+    status, _, body = run(asgi_call(app, '/echo', 'POST', [b'x' * 10, b'x' * 10], headers))
+    assert status == 413
+
+
+def test_asgi_streaming_response():
+    app = make_app()
+    status, headers, body = run(asgi_call(app, '/stream'))
+    assert b'content-length' not in headers
+    assert body == [b'one', b'two', b'three', b'']
+
+
+def test_asgi_lifespan():
+    app = make_app()
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    run(app.asgi({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert app.router._table is not None
+
+
+def test_async_view_over_wsgi():
+    status, _, body = call(make_app(), '/async/wsgi')
+    assert status == '200 OK'
+    assert body == b'Hello wsgi'
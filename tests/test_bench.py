@@ -0,0 +1,25 @@
+from spewe import bench
+
+
+def test_measure():
+    result = bench.measure(lambda: None, duration=0.01, warmup=0)
+    assert result['calls'] >= result['batch'] >= 1
+    assert result['min'] <= result['p50'] <= result['p90'] <= result['p99'] <= result['max']
+
+
+def test_run_and_compare(tmpdir):
+    results = bench.run(['request.get', 'wsgi.text'], duration=0.01)
+    assert list(results['results']) == ['request.get', 'wsgi.text']
+    path = str(tmpdir.join('results.json'))
+    bench.save(results, path)
+    baseline = bench.load(path)
+    assert bench.compare(baseline, results) == []
+    baseline['results']['wsgi.text']['ops'] = results['results']['wsgi.text']['ops'] * 2
+    assert [name for name, _, _, _ in bench.compare(baseline, results)] == ['wsgi.text']
+    assert bench.main(['wsgi.text', '-d', '0.01', '-c', path, '-t', '0.9']) == 0
+
+
+def test_compressed_case():
+    # the case fails to set up when the response isn't compressed
+    results = bench.run(['wsgi.page.compressed'], duration=0.01)
+    assert results['results']['wsgi.page.compressed']['calls'] >= 1
@@ -0,0 +1,202 @@
+import os
+import signal
+import socket
+import threading
+import time
+from wsgiref import simple_server
+
+try:
+    from http.client import HTTPConnection
+    from urllib.request import urlopen
+except (ImportError,):
+    from httplib import HTTPConnection
+    from urllib2 import urlopen
+
+from spewe import Spewe
+from spewe.http import StreamingResponse
+from spewe.server import PreforkServer, ThreadPoolMixIn, make_server_class
+
+
+class QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(app, server_class):
+    httpd = simple_server.make_server('localhost', 0, app, server_class=server_class,
+                                      handler_class=QuietHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd, 'http://localhost:%d' % httpd.server_port
+
+
+def test_threaded_server():
+    app = Spewe()
+    released = threading.Event()
+
+    @app.route('/slow')
+    def slow(request):
+        released.wait(5)
+        return 'slow'
+
+    @app.route(r'^/fast/(?P<name>\w+)$')
+    def fast(request, name):
+        return name
+
+    server_class = make_server_class(simple_server.WSGIServer, threads=4, backlog=16)
+    assert issubclass(server_class, ThreadPoolMixIn)
+    assert server_class.pool_size == 4 and server_class.request_queue_size == 16
+    httpd, url = serve(app, server_class)
+    try:
+        results = []
+        slow_client = threading.Thread(target=lambda: results.append(urlopen(url + '/slow').read()))
+        slow_client.start()
+        # the slow view must not block the other clients
+        assert urlopen(url + '/fast/kenny', timeout=5).read() == b'kenny'
+        assert urlopen(url + '/fast/stan', timeout=5).read() == b'stan'
+        released.set()
+        slow_client.join(5)
+        assert results == [b'slow']
+    finally:
+        released.set()
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_prefork_server():
+    app = Spewe()
+
+    @app.route('/pid')
+    def pid(request):
+        return str(os.getpid())
+
+    server = PreforkServer(app, 'localhost', 0, simple_server.WSGIServer, QuietHandler,
+                           workers=2, max_requests=1, reuse_port=True)
+    url = 'http://localhost:%d/pid' % server.bind().server_port
+    master = os.fork()
+    if not master:
+        try:
+            server.serve_forever()
+        finally:
+            os._exit(0)
+    try:
+        pids = set(urlopen(url, timeout=5).read() for _ in range(6))
+        # workers are replaced once they reach max_requests
+        assert len(pids) == 6
+        assert str(master).encode() not in pids
+    finally:
+        os.kill(master, signal.SIGTERM)
+        deadline = time.time() + 5
+        while time.time() < deadline and os.waitpid(master, os.WNOHANG) == (0, 0):
+            time.sleep(0.05)
+        else:
+            if time.time() >= deadline:
+                os.kill(master, signal.SIGKILL)
+                os.waitpid(master, 0)
+        server.httpd.server_close()
+
+
+def serve_asyncio(app, **options):
+    from spewe.aioserver import AsyncioServer
+    server = AsyncioServer(app, 'localhost', 0, **options)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    deadline = time.time() + 5
+    while server.server_port is None and time.time() < deadline:
+        time.sleep(0.01)
+    return server, thread
+
+
+def read_until(sock, marker, count=1):
+    data = b''
+    while data.count(marker) < count:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def asyncio_app():
+    app = Spewe()
+
+    @app.route('/client')
+    def client(request):
+        return str(request.environ['asgi.scope']['client'][1])
+
+    @app.route('/echo', methods=['POST'])
+    def echo(request):
+        return request.body
+
+    @app.route('/stream')
+    def stream(request):
+        return StreamingResponse(word for word in ('one', 'two', 'three'))
+
+    return app
+
+
+def test_asyncio_server_keep_alive():
+    server, thread = serve_asyncio(asyncio_app())
+    try:
+        conn = HTTPConnection('localhost', server.server_port, timeout=5)
+        ports = set()
+        for _ in range(3):
+            conn.request('GET', '/client')
+            response = conn.getresponse()
+            assert response.status == 200
+            ports.add(response.read())
+        # all the requests went through the same connection
+        assert len(ports) == 1
+        conn.request('POST', '/echo', body=b'hello', headers={'Content-Type': 'text/plain'})
+        assert conn.getresponse().read() == b'hello'
+        conn.request('GET', '/stream')
+        response = conn.getresponse()
+        assert response.getheader('Transfer-Encoding') == 'chunked'
+        assert response.read() == b'onetwothree'
+        conn.request('GET', '/nowhere')
+        response = conn.getresponse()
+        assert response.status == 404
+        response.read()
+        conn.close()
+    finally:
+        server.shutdown()
+        thread.join(5)
+
+
+def test_asyncio_server_pipelining():
+    server, thread = serve_asyncio(asyncio_app())
+    try:
+        sock = socket.create_connection(('localhost', server.server_port), timeout=5)
+        sock.sendall(b'POST /echo HTTP/1.1\r\nHost: localhost\r\nContent-Type: text/plain\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n'
+                     b'GET /client HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        data = read_until(sock, b'HTTP/1.1 200 OK', 2)
+        data += read_until(sock, b'never')
+        first, second = data.split(b'HTTP/1.1 200 OK')[1:]
+        assert first.endswith(b'\r\n\r\nhello world')
+        assert b'connection: close' in second
+        assert second.endswith(str(sock.getsockname()[1]).encode())
+        sock.close()
+    finally:
+        server.shutdown()
+        thread.join(5)
+
+
+def test_asyncio_server_limits():
+    server, thread = serve_asyncio(asyncio_app(), max_connections=1, header_timeout=0.2)
+    try:
+        idle = socket.create_connection(('localhost', server.server_port), timeout=5)
+        idle.sendall(b'GET /client HTTP/1.1\r\n')
+        time.sleep(0.05)
+        refused = socket.create_connection(('localhost', server.server_port), timeout=5)
+        assert read_until(refused, b'never').startswith(b'HTTP/1.1 503')
+        refused.close()
+        # the unfinished request head times out
+        assert read_until(idle, b'never') == b''
+        idle.close()
+    finally:
+        server.shutdown()
+        thread.join(5)
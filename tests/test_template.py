@@ -1,6 +1,10 @@
+from functools import partial
+
 import pytest
 
-from spewe.template import Template
+from spewe.cache import LRUCache
+from spewe.profiler import TemplateProfiler
+from spewe.template import Template, TemplateLoader, walk
 from spewe.exceptions import SpeweException
 
 
@@ -136,3 +140,172 @@ def test_node_integrity(context):
         tpl.render(context)
     assert issubclass(exc.type, (SpeweException,))
     assert exc.value.args[0] == 'invalid syntax in statement: <{% loop products %}> is an invalid opening block for <{% endif %}>'
+
+
+def test_compiled_template(context):
+    content = "{% loop books %}{% if item.price > 15 %}<b>{{item.title}}</b>{% else %}{{item.author}}{% endif %}{% endloop %}"
+    tpl = Template(content=content)
+    compiled = tpl.compile()
+    assert compiled is tpl.compile()
+    assert tpl.render(context) == Template(content=content).parser.parse().render(dict(context))
+    assert tpl.render({'books': []}) == ''
+    tpl = Template(content="{{ '#' }}{% if True %}{% endif %}")
+    assert tpl.render({}) == '#'
+
+
+def test_cache_fragment(context):
+    store = LRUCache()
+    content = ("<ul>{% cache menu user.username 60 %}{% loop books %}<li>{{item.title}}</li>{% endloop %}"
+               "{% endcache %}</ul>{{ user.username }}")
+    tpl = Template(content=content, cache=store)
+    rendered = tpl.render(context)
+    assert rendered.startswith('<ul><li>1984</li>') and rendered.endswith('</ul>cloking')
+    assert [key[2:] for key in store._entries] == [('menu', 'cloking')]
+    # the loop isn't run again for the same key
+    context['books'] = []
+    assert tpl.render(context) == rendered
+    context['user'].username = 'kenny'
+    assert tpl.render(context) == '<ul></ul>kenny'
+    assert len(store) == 2
+    # blocks of other templates sharing the name are kept apart
+    assert Template(content="{% cache menu 60 %}A-side{% endcache %}", cache=store).render({}) == 'A-side'
+    assert Template(content="{% cache menu 60 %}B-side{% endcache %}", cache=store).render({}) == 'B-side'
+    with pytest.raises(SpeweException) as exc:
+        Template(content="{% cache menu %}{% endcache %}").render({})
+    assert exc.value.args[0] == 'invalid syntax in statement: {% cache menu %}'
+
+
+def test_template_profiler(context):
+    content = "<ul>\n{% loop books %}\n{% if item.price > 15 %}<li>{{ item.title }}</li>{% endif %}\n{% endloop %}</ul>"
+    tpl = Template(name='books.html', content=content)
+    profiler = TemplateProfiler()
+    assert tpl.render(context, profiler=profiler) == tpl.render(context)
+    stats = dict((frame, (calls, size)) for frame, calls, total, self_time, size in profiler.stats())
+    assert stats[('books.html', 0, 'template')] == (1, len(tpl.render(context)))
+    assert stats[('books.html', 2, '{% loop books %}')][0] == 1
+    assert stats[('books.html', 3, '{% if item.price > 15 %}')][0] == 5
+    assert stats[('books.html', 3, 'expr item.title')] == (2, 0)
+    assert stats[('books.html', 3, '{{ item.title }}')] == (2, len('1984Roots'))
+    rows = profiler.stats('total')
+    assert rows[0][0] == ('books.html', 0, 'template')
+    assert profiler.report().splitlines()[1].endswith('books.html')
+    lines = profiler.collapsed().splitlines()
+    assert 'books.html;books.html:2 {% loop books %};books.html:3 {% if item.price > 15 %} ' in \
+        '\n'.join(line.rsplit(' ', 1)[0] + ' ' for line in lines)
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+
+
+def test_template_loader(tmpdir):
+    tmpdir.join('hello.html').write('Hello {{name}}')
+    loader = TemplateLoader(str(tmpdir), max_size=2, check_interval=0)
+    tpl = loader.get_template('hello.html')
+    assert tpl is loader.get_template('hello.html')
+    assert tpl.render({'name': 'Kenny'}) == 'Hello Kenny'
+    # modified templates are reloaded
+    tmpdir.join('hello.html').write('Bye {{name}} !!!')
+    assert loader.get_template('hello.html').render({'name': 'Kenny'}) == 'Bye Kenny !!!'
+    # least recently used templates are evicted
+    tmpdir.join('one.html').write('one')
+    tmpdir.join('two.html').write('two')
+    loader.get_template('one.html')
+    loader.get_template('two.html')
+    assert list(loader._templates) == [str(tmpdir.join('one.html')), str(tmpdir.join('two.html'))]
+    with pytest.raises(SpeweException) as exc:
+        loader.get_template('none.html')
+    assert exc.value.args[0] == 'template %s not found' % tmpdir.join('none.html')
+    # no mtime check when disabled
+    loader = TemplateLoader(str(tmpdir))
+    tpl = loader.get_template('one.html')
+    tmpdir.join('one.html').write('one more time')
+    assert loader.get_template('one.html') is tpl
+
+
+def test_template_inheritance(tmpdir, monkeypatch):
+    tmpdir.join('base.html').write(
+        '<title>{% block title %}Site{% endblock %}</title>{% include "nav.html" %}'
+        '{% block content %}<p>{% block lead %}lead{% endblock %}</p>{% endblock %}')
+    tmpdir.join('nav.html').write('<nav>{{ user }}</nav>')
+    tmpdir.join('page.html').write(
+        '{% extends "base.html" %}\n{% block title %}Page{% endblock %}\n'
+        'ignored{% block lead %}{{ user }}{% include "nav.html" %}{% endblock %}')
+    loader = TemplateLoader(str(tmpdir), check_interval=0)
+    tpl = loader.get_template('page.html')
+    assert tpl.dependencies == {str(tmpdir.join('base.html')), str(tmpdir.join('nav.html'))}
+    # rendering never reads the extended or included files again
+    monkeypatch.setattr('io.open', None)
+    assert tpl.render({'user': 'kenny'}) == '<title>Page</title><nav>kenny</nav><p>kenny<nav>kenny</nav></p>'
+    monkeypatch.undo()
+    # editing the base template expires its children
+    tmpdir.join('base.html').write('{% block title %}{% endblock %} {% block lead %}{% endblock %} !!!')
+    assert loader.get_template('page.html').render({'user': 'kenny'}) == 'Page kenny<nav>kenny</nav> !!!'
+    # the blocks of an included template aren't overrides, nor modified
+    tmpdir.join('widget.html').write('{% block title %}Widget{% endblock %}')
+    tmpdir.join('dashboard.html').write(
+        '{% extends "base.html" %}{% block lead %}{% include "widget.html" %}{% endblock %}'
+        '{% block title %}Dashboard{% endblock %}')
+    assert loader.get_template('dashboard.html').render({}) == 'Dashboard Widget !!!'
+    assert loader.get_template('widget.html').tree.children[0].template is None
+    tmpdir.join('loop.html').write('{% include "loop.html" %}')
+    with pytest.raises(SpeweException) as exc:
+        loader.get_template('loop.html')
+    assert exc.value.args[0].endswith('loop.html: circular extends or include')
+    with pytest.raises(SpeweException) as exc:
+        Template(content='<p>{% extends "base.html" %}').render({})
+    assert exc.value.args[0] == 'invalid syntax in statement: <{% extends "base.html" %}> must be the first tag of the template'
+
+
+def test_template_lexer(tmpdir):
+    tpl = Template(content="<ul>\n  {%- loop books -%}\n  <li>{{\n    item.title }}</li>\n{%- endloop %}\n</ul>")
+    assert tpl.render({'books': [Book(title='Roots')]}) == '<ul><li>Roots</li>\n</ul>'
+    assert [(token.lineno, token.col) for token in tpl.parser.tokens] == [(1, 1), (2, 3), (2, 21), (3, 7), (4, 18),
+                                                                          (5, 1), (5, 15)]
+    # syntax errors point to the faulty tag
+    with pytest.raises(SpeweException) as exc:
+        Template(content="<p>\n  {% if user %}{{ user.name }<br>{{ user.age }}{% endif %}").render({})
+    assert exc.value.args[0] == 'invalid syntax in statement: <{{ user.name }<br>>: tag not closed'
+    assert (exc.value.lineno, exc.value.col) == (2, 16)
+    tmpdir.join('page.html').write('<p>\n{% loop books %}\n  {{ item >= }}\n{% endloop %}')
+    with pytest.raises(SpeweException) as exc:
+        TemplateLoader(str(tmpdir)).get_template('page.html')
+    assert str(exc.value) == 'invalid syntax in statement: item >= (%s, line 3, column 3)' % tmpdir.join('page.html')
+    with pytest.raises(SpeweException) as exc:
+        Template(content="{% if user %}\n{% endloop %}").render({})
+    assert (exc.value.lineno, exc.value.col) == (2, 1)
+
+
+def test_template_optimizer(context):
+    tpl = Template(content="<p>{% if 1 > 2 %}no{% else %}{{ 'yes' }}{% endif %}{{ 42 }}</p>{% if user %}{{ user.username }}{% endif %}")
+    root = tpl.optimized
+    assert [child.token.content for child in root.children[:1]] == ['<p>yes42</p>']
+    assert isinstance(root.children, tuple) and len(root.children) == 2
+    # the optimized tree is shared by the renderings and can't be modified
+    assert all(isinstance(node.children, tuple) for node in walk(root))
+    assert tpl.render(context) == '<p>yes42</p>cloking'
+    # names not depending on the item are looked up once per loop, but
+    # callables are still called on each iteration
+    calls = []
+
+    def currency():
+        calls.append(1)
+        return '$'
+
+    tpl = Template(content="{% loop books %}{{ '%s ' % item.title }}{{ currency }}{{ item.price }} {% endloop %}")
+    context['currency'] = currency
+    assert tpl.render(context) == '1984 $20 Animal Farm $15 Beloved $15 Roots $20 So Long A Letter $15 '
+    assert len(calls) == 5
+    context['books'] = []
+    assert tpl.render(context) == '' and len(calls) == 5
+    context['books'] = [Book(title='Roots', price=20)]
+    del context['currency']
+    with pytest.raises(SpeweException) as exc:
+        tpl.render(context)
+    assert exc.value.args[0] == '<currency> does not exist in context'
+    # nested loop iterables aren't reused, a generator is only consumed once
+    tpl = Template(content="{% loop books %}[{{ item }}:{% loop tags %}{{ item }}{% endloop %}]{% endloop %}")
+    assert tpl.render({'books': [1, 2, 3], 'tags': lambda: (tag for tag in 'ab')}) == '[1:ab][2:ab][3:ab]'
+    counter = partial(next, iter(range(3)))
+    tpl = Template(content="{% loop xs %}{{ counter }}{% endloop %}")
+    assert tpl.render({'xs': [1, 2, 3], 'counter': counter}) == '012'
+    # calls may have side effects, they're never hoisted
+    tpl = Template(content="{% loop xs %}{{ ys.pop() }}{% endloop %}")
+    assert tpl.render({'xs': [1, 2], 'ys': [1, 2, 3]}) == '32'
@@ -1,4 +1,5 @@
 import os
+import wsgiref.util
 
 
 def get_test_dir():
@@ -7,3 +8,23 @@ def get_test_dir():
 
 def get_test_app_template(tplname):
     return os.path.join(get_test_dir(), 'myapp', 'templates', tplname)
+
+
+def call(app, path, **environ):
+    """Call a wsgi app directly and return its status, headers and body"""
+    env = {'PATH_INFO': path}
+    env.update(environ)
+    wsgiref.util.setup_testing_defaults(env)
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = status
+        response['headers'] = dict(headers)
+
+    body = app(env, start_response)
+    try:
+        content = b''.join(body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return response['status'], response['headers'], content